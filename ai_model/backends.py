@@ -0,0 +1,214 @@
+import os
+import tempfile
+
+import numpy as np
+
+MODEL_DIR = os.path.dirname(__file__)
+KERAS_MODEL_PATH = os.path.join(MODEL_DIR, 'best_model.keras')
+QUANTIZATIONS = ('float32', 'float16', 'dynamic', 'int8')
+
+
+class KerasBackend:
+    """Runs the Keras model directly."""
+
+    name = 'keras'
+
+    def __init__(self, model_path=KERAS_MODEL_PATH):
+        import tensorflow as tf
+
+        print(f"[DEBUG] Loading Keras model from: {model_path}")
+        self.model = tf.keras.models.load_model(model_path)
+
+    def predict(self, batch):
+        return np.asarray(self.model.predict(batch, verbose=0))
+
+
+def build_dense_model(model, patch_size=(64, 64), scale=1.0, feature_stride=32):
+    """Fully-convolutional variant of the patch classifier.
+
+    Runs the backbone once over a whole tile, average-pools its feature map
+    over each patch footprint (what GlobalAveragePooling2D does for a single
+    patch) and applies the Dense head to every pooled cell. Input tiles are
+    resized by ``scale`` first, so output cell (i, j) classifies source patch
+    (i, j). ``feature_stride`` is the backbone's downsampling (32 for
+    EfficientNetB0).
+
+    This approximates per-patch classification rather than reproducing it:
+    the backbone's receptive field crosses patch borders, so a cell's
+    features depend on neighbouring patches in the same tile. Only tiles
+    holding a single patch match patch mode exactly.
+    """
+    import tensorflow as tf
+
+    layers = model.layers
+    pool_index = next(i for i, layer in enumerate(layers)
+                      if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D))
+    cells = [p * scale / feature_stride for p in patch_size]
+    if any(c != int(c) or c < 1 for c in cells):
+        raise ValueError(f"Patch size {patch_size} at scale {scale} is not a multiple of the "
+                         f"backbone stride {feature_stride}")
+
+    inputs = tf.keras.Input((None, None, 3))
+    x = inputs
+    for layer in layers[:pool_index]:
+        if isinstance(layer, tf.keras.Model):
+            # Rebuild nested models (the backbone) without their fixed input size
+            clone = tf.keras.models.clone_model(layer, input_tensors=tf.keras.Input((None, None, 3)))
+            clone.set_weights(layer.get_weights())
+            layer = clone
+        x = layer(x)
+    x = tf.keras.layers.AveragePooling2D(pool_size=tuple(int(c) for c in cells))(x)
+    for layer in layers[pool_index + 1:]:
+        if not isinstance(layer, tf.keras.layers.Dropout):
+            x = layer(x)  # Dense acts on the channel axis of every cell
+    return tf.keras.Model(inputs, x)
+
+
+class DenseBackend:
+    """Whole-tile inference with the fully-convolutional model (see build_dense_model)."""
+
+    name = 'dense'
+
+    def __init__(self, patch_size=(64, 64), scale=1.0, model_path=KERAS_MODEL_PATH):
+        import tensorflow as tf
+
+        print(f"[DEBUG] Loading Keras model for dense inference from: {model_path}")
+        self.model = build_dense_model(tf.keras.models.load_model(model_path), patch_size, scale)
+
+    def predict(self, tiles):
+        """``(N, H, W, 3)`` preprocessed tiles to ``(N, rows, cols, classes)`` patch probabilities."""
+        return np.asarray(self.model(tiles, training=False))
+
+
+class TFLiteBackend:
+    """Runs a (optionally quantized) TFLite conversion of the model.
+
+    Resizing an interpreter's input reallocates all of its tensors, so batches
+    are zero-padded to the next power of two (capped at ``max_batch_size``,
+    larger batches are split) and each padded size keeps its own interpreter.
+    Tensors are allocated once per size, and at most half a batch is padding.
+    """
+
+    name = 'tflite'
+
+    def __init__(self, model_path, num_threads=None, max_batch_size=128):
+        print(f"[DEBUG] Loading TFLite model from: {model_path}")
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.max_batch_size = max_batch_size
+        self._interpreters = {}  # Padded batch size -> (interpreter, input details, output details)
+        self._interpreter(1)  # Fail on a bad model at load time
+
+    def padded_size(self, batch_size):
+        return min(1 << max(batch_size - 1, 0).bit_length(), self.max_batch_size)
+
+    def _interpreter(self, batch_size):
+        if batch_size not in self._interpreters:
+            interpreter = _tflite_interpreter(self.model_path, self.num_threads)
+            input_details = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(input_details['index'], [batch_size, *input_details['shape'][1:]])
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = (interpreter, interpreter.get_input_details()[0],
+                                              interpreter.get_output_details()[0])
+        return self._interpreters[batch_size]
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        return np.concatenate([self._predict_padded(batch[i:i + self.max_batch_size])
+                               for i in range(0, len(batch), self.max_batch_size)])
+
+    def _predict_padded(self, batch):
+        count = len(batch)
+        size = self.padded_size(count)
+        interpreter, input_details, output_details = self._interpreter(size)
+        if size > count:
+            batch = np.concatenate([batch, np.zeros((size - count, *batch.shape[1:]), dtype=batch.dtype)])
+
+        input_dtype = input_details['dtype']
+        if np.issubdtype(input_dtype, np.integer):
+            scale, zero_point = input_details['quantization']
+            info = np.iinfo(input_dtype)
+            batch = np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(input_dtype)
+
+        interpreter.set_tensor(input_details['index'], batch)
+        interpreter.invoke()
+        output = interpreter.get_tensor(output_details['index'])[:count]
+
+        if np.issubdtype(output.dtype, np.integer):
+            scale, zero_point = output_details['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+def _tflite_interpreter(model_path, num_threads):
+    # Prefer the standalone runtimes on CPU-only hosts; fall back to TensorFlow's
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads)
+
+
+def tflite_model_path(quantization):
+    return os.path.join(MODEL_DIR, f'best_model_{quantization}.tflite')
+
+
+def convert_to_tflite(output_path, quantization='float16', keras_path=KERAS_MODEL_PATH, representative_batches=None):
+    """Convert the Keras model to TFLite.
+
+    ``quantization`` is one of ``QUANTIZATIONS``: 'float16' halves weights,
+    'dynamic' stores int8 weights, and 'int8' fully quantizes weights and
+    activations (inputs/outputs stay float), which needs
+    ``representative_batches`` -- an iterable of preprocessed float32 batches.
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+
+    model = tf.keras.models.load_model(keras_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if representative_batches is None:
+            raise ValueError("int8 quantization needs representative_batches")
+
+        def representative_dataset():
+            for batch in representative_batches:
+                for sample in np.asarray(batch, dtype=np.float32):
+                    yield [sample[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    # Write beside the target and rename, so concurrent loaders never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix='.tflite.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(converter.convert())
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    print(f"[DEBUG] Wrote {quantization} TFLite model to: {output_path}")
+    return output_path
+
+
+def load_backend(name='keras', quantization='float16', num_threads=None, representative_batches=None,
+                 max_batch_size=128):
+    """Build the configured backend, converting the TFLite model on first use."""
+    if name == 'keras':
+        return KerasBackend()
+    if name == 'tflite':
+        path = tflite_model_path(quantization)
+        if not os.path.exists(path):
+            convert_to_tflite(path, quantization, representative_batches=representative_batches)
+        return TFLiteBackend(path, num_threads, max_batch_size)
+    raise ValueError(f"Unknown inference backend '{name}', expected 'keras' or 'tflite'")
@@ -0,0 +1,90 @@
+"""Compare inference backends on latency and accuracy.
+
+Usage:
+    python benchmark.py --backends keras tflite:float16 tflite:int8
+    python benchmark.py --labeled /path/to/EuroSAT_RGB   # class-named subfolders
+
+Without ``--labeled`` the patches come from ``--images`` and accuracy is
+reported as top-1 agreement with the first backend listed.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from backends import load_backend
+from infer import (CALIBRATION_IMAGE_DIR, MODEL_INPUT_SIZE, PATCH_SIZE, PREPROCESS_DTYPE,
+                   calibration_batches, get_class_names, get_image_patches)
+from preprocess import preprocess_batch
+
+
+def load_unlabeled(image_dir, max_images):
+    names = sorted(n for n in os.listdir(image_dir) if n.lower().endswith(('.png', '.jpg', '.jpeg')))
+    patches = [get_image_patches(os.path.join(image_dir, n))[0] for n in names[:max_images]]
+    return np.concatenate(patches), None
+
+
+def load_labeled(dataset_dir, max_per_class):
+    class_names = get_class_names()
+    patches, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(dataset_dir, class_name)
+        if not os.path.isdir(class_dir):
+            continue
+        for name in sorted(os.listdir(class_dir))[:max_per_class]:
+            image = Image.open(os.path.join(class_dir, name)).convert("RGB").resize(PATCH_SIZE)
+            patches.append(np.asarray(image))
+            labels.append(label)
+    return np.stack(patches), np.asarray(labels)
+
+
+def run(backend, batch, batch_size, repeats):
+    """Predicted classes and best-of-``repeats`` seconds for the whole batch."""
+    backend.predict(batch[:batch_size])  # Warm-up
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        outputs = [backend.predict(batch[i:i + batch_size]) for i in range(0, len(batch), batch_size)]
+        best = min(best, time.perf_counter() - start)
+    return np.argmax(np.concatenate(outputs), axis=1), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['keras', 'tflite:float16', 'tflite:int8'],
+                        help="'keras' or 'tflite:<quantization>'")
+    parser.add_argument('--images', default=CALIBRATION_IMAGE_DIR, help="Directory of images to tile")
+    parser.add_argument('--labeled', help="Dataset directory with one subfolder per class")
+    parser.add_argument('--max-images', type=int, default=20, help="Images (or images per class) to use")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.labeled:
+        patches, labels = load_labeled(args.labeled, args.max_images)
+    else:
+        patches, labels = load_unlabeled(args.images, args.max_images)
+    batch = np.asarray(preprocess_batch(patches, MODEL_INPUT_SIZE, PREPROCESS_DTYPE), dtype=np.float32)
+    print(f"Benchmarking {len(batch)} patches, batch size {args.batch_size}, input dtype {PREPROCESS_DTYPE}")
+
+    reference = None
+    print(f"{'backend':<18}{'ms/patch':>10}{'patches/s':>12}{'agreement':>11}{'accuracy':>10}")
+    for spec in args.backends:
+        name, _, quantization = spec.partition(':')
+        backend = load_backend(name, quantization or 'float16', args.threads,
+                               representative_batches=calibration_batches(args.images),
+                               max_batch_size=args.batch_size)
+        predicted, seconds = run(backend, batch, args.batch_size, args.repeats)
+        if reference is None:
+            reference = predicted
+        agreement = np.mean(predicted == reference)
+        accuracy = f"{np.mean(predicted == labels):>10.3f}" if labels is not None else f"{'-':>10}"
+        print(f"{spec:<18}{seconds / len(batch) * 1000:>10.3f}{len(batch) / seconds:>12.1f}"
+              f"{agreement:>11.3f}{accuracy}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+
+NO_PATCH = 255  # Grid value for cells without a classified patch
+MAP_ENCODINGS = ('rle', 'png', 'raw')
+
+
+def build_class_map(class_indices, positions, stride):
+    """Place per-patch class indices on a uint8 grid aligned to patch origins."""
+    positions = np.asarray(positions).reshape(-1, 2)
+    if not len(positions):
+        return np.empty((0, 0), dtype=np.uint8)
+    cells = positions // np.asarray(stride)
+    grid = np.full(cells.max(axis=0) + 1, NO_PATCH, dtype=np.uint8)
+    grid[cells[:, 0], cells[:, 1]] = np.asarray(class_indices, dtype=np.uint8)
+    return grid
+
+
+def rle_encode(grid):
+    """Row-major run-length encoding: ``{'shape', 'values', 'runs'}``."""
+    flat = np.asarray(grid, dtype=np.uint8).ravel()
+    if not len(flat):
+        return {"shape": list(np.shape(grid)), "values": [], "runs": []}
+    starts = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]])
+    runs = np.diff(np.r_[starts, len(flat)])
+    return {"shape": list(np.shape(grid)), "values": flat[starts].tolist(), "runs": runs.tolist()}
+
+
+def rle_decode(encoded):
+    values = np.asarray(encoded["values"], dtype=np.uint8)
+    return np.repeat(values, encoded["runs"]).reshape(encoded["shape"])
+
+
+def png_encode(grid):
+    """Grid as a base64 single-channel PNG whose pixel values are class indices."""
+    buffer = io.BytesIO()
+    Image.fromarray(np.asarray(grid, dtype=np.uint8)).save(buffer, format='PNG', optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def encode_class_map(grid, encoding='rle'):
+    """Serialize a class grid for JSON responses in one of ``MAP_ENCODINGS``."""
+    if encoding == 'rle':
+        return rle_encode(grid)
+    if encoding == 'png':
+        return {"shape": list(grid.shape), "png": png_encode(grid)}
+    if encoding == 'raw':
+        return {"shape": list(grid.shape), "grid": grid.tolist()}
+    raise ValueError(f"Unknown class map encoding '{encoding}', expected one of {MAP_ENCODINGS}")
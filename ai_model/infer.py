@@ -1,95 +1,272 @@
-import tensorflow as tf
 import numpy as np
 import json
 import os
 from PIL import Image
 import collections
-import time  # For adding delay in simulation
+import threading
+import time  # For simulated inference latency
+
+try:
+    from .backends import DenseBackend, load_backend
+    from .class_map import build_class_map
+    from .model_server import InferenceServer
+    from .preprocess import preprocess_batch
+except ImportError:
+    from backends import DenseBackend, load_backend
+    from class_map import build_class_map
+    from model_server import InferenceServer
+    from preprocess import preprocess_batch
 
 # Toggle this to switch between simulation and real inference
 USE_SIMULATION = True  # Change to False to use trained model
 
-# Load class names
+# TensorFlow, the model and class names are loaded on first use so importing
+# this module (e.g. from the backend) stays cheap; see warm_up()
 class_names_path = os.path.join(os.path.dirname(__file__), 'class_names.json')
-print(f"[DEBUG] Loading class names from: {class_names_path}")
-with open(class_names_path, 'r') as f:
-    class_names = json.load(f)
-print("[DEBUG] Class names loaded:", class_names)
+_class_names = None
+_class_names_lock = threading.Lock()
+_inference_server = None
+_inference_server_lock = threading.Lock()
+_dense_backend = None
+_dense_backend_lock = threading.Lock()
+
+def get_class_names():
+    global _class_names
+    if _class_names is None:
+        with _class_names_lock:
+            if _class_names is None:
+                print(f"[DEBUG] Loading class names from: {class_names_path}")
+                with open(class_names_path, 'r') as f:
+                    _class_names = json.load(f)
+                print("[DEBUG] Class names loaded:", _class_names)
+    return _class_names
+
+def __getattr__(name):
+    # Keeps ``infer.class_names`` working while loading it lazily
+    if name == 'class_names':
+        return get_class_names()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Constants
 PATCH_SIZE = (64, 64)
 MODEL_INPUT_SIZE = (224, 224)
 
-# Load model only if needed
-if not USE_SIMULATION:
-    model_path = os.path.join(os.path.dirname(__file__), 'best_model.keras')
-    print(f"[DEBUG] Loading model from: {model_path}")
-    model = tf.keras.models.load_model(model_path)
-    print("[DEBUG] Model loaded successfully.")
+def parse_stride(value):
+    """``"32"`` (square) or ``"32,16"`` as a (rows, cols) stride of positive ints."""
+    try:
+        stride = tuple(int(v) for v in value.split(','))
+    except ValueError:
+        stride = ()
+    if len(stride) == 1:
+        stride *= 2
+    if len(stride) != 2 or min(stride) < 1:
+        raise ValueError(f"PATCH_STRIDE must be one or two positive integers, got {value!r}")
+    return stride
+
+# Patch stride; smaller than PATCH_SIZE overlaps patches for accuracy at the cost of throughput
+PATCH_STRIDE = parse_stride(os.getenv('PATCH_STRIDE', f"{PATCH_SIZE[0]},{PATCH_SIZE[1]}"))
+
+# Input precision for the model: float32/float16 scaled to [0, 1], or uint8 (0-255)
+PREPROCESS_DTYPE = os.getenv('PREPROCESS_DTYPE', 'float32')
+
+# Bump when best_model.keras is retrained so cached classifications are not reused
+MODEL_VERSION = os.getenv('MODEL_VERSION', '1')
+
+# Inference backend: 'keras', or 'tflite' with TFLITE_QUANTIZATION of
+# float32/float16/dynamic/int8 (converted from best_model.keras on first use)
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'keras')
+TFLITE_QUANTIZATION = os.getenv('TFLITE_QUANTIZATION', 'float16')
+TFLITE_NUM_THREADS = int(os.getenv('TFLITE_NUM_THREADS', os.cpu_count() or 1))
+# Inference mode: 'patch' upsamples every patch to MODEL_INPUT_SIZE; 'dense' runs
+# a fully-convolutional variant of the Keras model over whole tiles resized by
+# DENSE_SCALE (default 1: native resolution, so a 512x512 image is one 512x512
+# pass, 1/12 of patch mode's input pixels). Backbone compute scales with input
+# pixels, so DENSE_SCALE=3.5 (patch mode's 64->224 scale) costs as much as patch
+# mode. Dense output approximates patch mode: the backbone sees across patch
+# borders within a tile. DENSE_TILE_SIZE caps the model input side per forward
+# pass, which bounds memory at any scale
+INFERENCE_MODE = os.getenv('INFERENCE_MODE', 'patch')
+DENSE_TILE_SIZE = int(os.getenv('DENSE_TILE_SIZE', 512))
+DENSE_SCALE = float(os.getenv('DENSE_SCALE', 1))
+# Images used to calibrate int8 quantization
+CALIBRATION_IMAGE_DIR = os.getenv(
+    'CALIBRATION_IMAGE_DIR',
+    os.path.join(os.path.dirname(__file__), '..', 'backend', 'static', 'images'))
+
+def model_signature():
+    """Identifies everything that affects classification output, for result caching."""
+    if USE_SIMULATION:
+        mode = 'simulation'
+    elif dense_inference_enabled():
+        mode = f"model-{MODEL_VERSION}-dense-x{DENSE_SCALE}-tile{DENSE_TILE_SIZE}"
+    elif INFERENCE_BACKEND == 'tflite':
+        mode = f"model-{MODEL_VERSION}-tflite-{TFLITE_QUANTIZATION}"
+    else:
+        mode = f"model-{MODEL_VERSION}"
+    return f"{mode}|patch={PATCH_SIZE}|stride={PATCH_STRIDE}|input={MODEL_INPUT_SIZE}|dtype={PREPROCESS_DTYPE}"
+
+# Batching knobs for the inference server
+MAX_BATCH_SIZE = int(os.getenv('INFERENCE_MAX_BATCH_SIZE', 128))
+MAX_WAIT_MS = float(os.getenv('INFERENCE_MAX_WAIT_MS', 10))
+# After a failed model load, requests reuse the error for this long before a reload is tried
+MODEL_LOAD_RETRY_SECONDS = float(os.getenv('MODEL_LOAD_RETRY_SECONDS', 60))
 
-def get_image_patches(image_path, patch_size=PATCH_SIZE):
+def dense_inference_enabled():
+    return not USE_SIMULATION and INFERENCE_MODE == 'dense'
+
+def calibration_batches(image_dir=CALIBRATION_IMAGE_DIR, max_images=20):
+    """Preprocessed patch batches from sample images, for int8 quantization."""
+    names = sorted(n for n in os.listdir(image_dir) if n.lower().endswith(('.png', '.jpg', '.jpeg')))
+    for name in names[:max_images]:
+        patches, _ = get_image_patches(os.path.join(image_dir, name))
+        if len(patches):
+            yield np.asarray(preprocess_batch(patches, MODEL_INPUT_SIZE, PREPROCESS_DTYPE), dtype=np.float32)
+
+def load_model():
+    """Load the configured inference backend (see INFERENCE_BACKEND)."""
+    backend = load_backend(INFERENCE_BACKEND, TFLITE_QUANTIZATION, TFLITE_NUM_THREADS,
+                           representative_batches=calibration_batches(), max_batch_size=MAX_BATCH_SIZE)
+    print(f"[DEBUG] {backend.name} backend loaded successfully.")
+    return backend
+
+def predict_patches(backend, patches):
+    processed_patches = preprocess_batch(patches, MODEL_INPUT_SIZE, PREPROCESS_DTYPE)
+    return backend.predict(processed_patches)
+
+def inference_server_usable(server):
+    return server is not None and (
+        server.failed_at is None or time.monotonic() - server.failed_at < MODEL_LOAD_RETRY_SECONDS)
+
+def get_inference_server():
+    """Server thread owning the model, started (and the model loaded) on first call.
+
+    Raises if the model failed to load; the load is retried at most every
+    MODEL_LOAD_RETRY_SECONDS.
+    """
+    global _inference_server
+    server = _inference_server
+    if not inference_server_usable(server):
+        with _inference_server_lock:
+            if not inference_server_usable(_inference_server):
+                _inference_server = InferenceServer(load_model, predict_patches, MAX_BATCH_SIZE,
+                                                    MAX_WAIT_MS).start(wait=False)
+            server = _inference_server
+    return server.start()  # Waits for the model; raises a load failure
+
+def get_dense_backend():
+    """Fully-convolutional model for INFERENCE_MODE=dense, built on first call."""
+    global _dense_backend
+    if _dense_backend is None:
+        with _dense_backend_lock:
+            if _dense_backend is None:
+                _dense_backend = DenseBackend(PATCH_SIZE, DENSE_SCALE)
+    return _dense_backend
+
+def warm_up():
+    """Load everything inference needs up front and run one dummy batch through the model."""
+    get_class_names()
+    if dense_inference_enabled():
+        classify_dense_tiles(np.zeros((*PATCH_SIZE, 3), dtype=np.uint8))
+    elif not USE_SIMULATION:
+        get_inference_server().predict(np.zeros((1, *PATCH_SIZE, 3), dtype=np.uint8))
+    print("[DEBUG] Inference warm-up complete.")
+
+def load_image(image_path):
     print(f"[DEBUG] Opening image: {image_path}")
-    image = Image.open(image_path).convert("RGB")
-    image = np.array(image)
+    image = np.asarray(Image.open(image_path).convert("RGB"))
+    print(f"[DEBUG] Image size: {image.shape[1]}x{image.shape[0]}")
+    return image
+
+def get_image_patches(image_path, patch_size=PATCH_SIZE, stride=None):
+    """Tile an image into patches via a strided view.
+
+    ``stride`` defaults to ``patch_size`` (no overlap); a smaller stride gives
+    overlapping patches. Returns an ``(N, ph, pw, 3)`` uint8 array and the
+    ``(N, 2)`` array of (row, col) patch origins.
+    """
+    stride = stride or patch_size
+    image = load_image(image_path)
     h, w, _ = image.shape
-    print(f"[DEBUG] Image size: {w}x{h}")
-
-    patches = []
-    positions = []
-
-    print("[DEBUG] Starting patch extraction...")
-    for i in range(0, h, patch_size[0]):
-        for j in range(0, w, patch_size[1]):
-            if i + patch_size[0] <= h and j + patch_size[1] <= w:
-                patch = image[i:i+patch_size[0], j:j+patch_size[1]]
-                patches.append(patch)
-                positions.append((i, j))
+
+    if h < patch_size[0] or w < patch_size[1]:
+        print("[DEBUG] Image smaller than one patch")
+        return np.empty((0, *patch_size, 3), dtype=image.dtype), np.empty((0, 2), dtype=int)
+
+    windows = np.lib.stride_tricks.sliding_window_view(image, (*patch_size, 3))[::stride[0], ::stride[1], 0]
+    rows, cols = windows.shape[:2]
+    patches = windows.reshape(rows * cols, *patch_size, 3)
+    positions = np.stack(np.meshgrid(np.arange(rows) * stride[0], np.arange(cols) * stride[1], indexing='ij'),
+                         axis=-1).reshape(-1, 2)
     print(f"[DEBUG] Total patches extracted: {len(patches)}")
     return patches, positions
 
-def preprocess_patch(patch):
-    patch = Image.fromarray(patch)
-    patch = patch.resize(MODEL_INPUT_SIZE)
-    patch = np.array(patch).astype(np.float32) / 255.0
-    return patch
-
 # ---- Simulation Logic ----
-def softmax(x):
-    e_x = np.exp(x - np.max(x))
-    return e_x / e_x.sum()
+# Synthetic latency: fixed overhead per call plus a cost per patch, so load
+# tests scale with the amount of work like real inference does
+SIMULATION_BASE_LATENCY_MS = float(os.getenv('SIMULATION_BASE_LATENCY_MS', 50))
+SIMULATION_PATCH_LATENCY_MS = float(os.getenv('SIMULATION_PATCH_LATENCY_MS', 15))
+# Set for reproducible simulated predictions
+SIMULATION_SEED = os.getenv('SIMULATION_SEED')
 
-def simulate_classification(patches, class_names):
-    print("[DEBUG] Simulating realistic predictions...")
-    time.sleep(10)  # Add 2 seconds delay to mimic real processing time
+simulation_rng = np.random.default_rng(None if SIMULATION_SEED is None else int(SIMULATION_SEED))
+simulation_lock = threading.Lock()  # Generators are not thread-safe
 
-    num_classes = len(class_names)
-    
-    base_bias = np.random.normal(0, 0.3, size=num_classes)
-    base_bias[1] += 1.0
-    base_bias[7] += 0.8
+def simulated_latency(num_patches):
+    """Seconds a simulated inference call over ``num_patches`` patches takes."""
+    return (SIMULATION_BASE_LATENCY_MS + SIMULATION_PATCH_LATENCY_MS * num_patches) / 1000.0
 
-    class_indices = []
+def simulate_classification(patches, class_names, rng=None):
+    print("[DEBUG] Simulating realistic predictions...")
+    num_patches, num_classes = len(patches), len(class_names)
 
-    for patch in patches:
-        patch_noise = np.random.normal(0, 0.5, size=num_classes)
-        logits = base_bias + patch_noise
-        probabilities = softmax(logits)
-        predicted_class = np.random.choice(np.arange(num_classes), p=probabilities)
-        class_indices.append(predicted_class)
+    with simulation_lock:
+        rng = rng or simulation_rng
+        base_bias = rng.normal(0, 0.3, size=num_classes)
+        base_bias[1] += 1.0
+        base_bias[7] += 0.8
+        logits = base_bias + rng.normal(0, 0.5, size=(num_patches, num_classes))
+        # Gumbel-max: argmax(logits + Gumbel noise) samples from softmax(logits)
+        class_indices = np.argmax(logits + rng.gumbel(size=logits.shape), axis=1)
 
-    print(f"[DEBUG] Simulated predicted class indices: {class_indices[:30]}... (first 30 shown)")
+    time.sleep(simulated_latency(num_patches))
+    print(f"[DEBUG] Simulated predicted class indices: {class_indices[:30].tolist()}... (first 30 shown)")
     return class_indices
 
 # ---- Real Model Classification ----
-def classify_patches_with_model(model, patches):
-    print("[DEBUG] Preprocessing patches for real model...")
-    processed_patches = np.array([preprocess_patch(p) for p in patches])
-    print(f"[DEBUG] Shape of processed batch: {processed_patches.shape}")
-    predictions = model.predict(processed_patches, verbose=0)
+def classify_patches_with_model(patches):
+    print(f"[DEBUG] Submitting {len(patches)} patches to the inference server...")
+    predictions = get_inference_server().predict(np.asarray(patches))
     class_indices = np.argmax(predictions, axis=1)
     print(f"[DEBUG] Real model predicted class indices: {class_indices.tolist()[:30]}... (first 30 shown)")
     return class_indices
 
+def classify_dense_tiles(image):
+    """Class index per non-overlapping patch of an image array, a few tiles per forward pass.
+
+    Only whole patches are classified, like ``get_image_patches`` with the
+    default stride. Returns the class indices and ``(N, 2)`` patch origins.
+    """
+    ph, pw = PATCH_SIZE
+    rows, cols = image.shape[0] // ph, image.shape[1] // pw
+    tile_rows = max(int(DENSE_TILE_SIZE // (ph * DENSE_SCALE)), 1)
+    tile_cols = max(int(DENSE_TILE_SIZE // (pw * DENSE_SCALE)), 1)
+    backend = get_dense_backend()
+    grid = np.zeros((rows, cols), dtype=int)
+    passes = 0
+    for r in range(0, rows, tile_rows):
+        for c in range(0, cols, tile_cols):
+            tile = image[r * ph:(r + tile_rows) * ph, c * pw:(c + tile_cols) * pw]
+            size = (round(tile.shape[0] * DENSE_SCALE), round(tile.shape[1] * DENSE_SCALE))
+            probabilities = backend.predict(preprocess_batch(tile[np.newaxis], size, PREPROCESS_DTYPE))
+            grid[r:r + tile_rows, c:c + tile_cols] = np.argmax(probabilities[0], axis=-1)
+            passes += 1
+    positions = np.stack(np.meshgrid(np.arange(rows) * ph, np.arange(cols) * pw, indexing='ij'),
+                         axis=-1).reshape(-1, 2)
+    input_ratio = DENSE_SCALE ** 2 * ph * pw / (MODEL_INPUT_SIZE[0] * MODEL_INPUT_SIZE[1])
+    print(f"[DEBUG] Dense model classified {rows * cols} patches in {passes} forward passes "
+          f"({input_ratio:.2f}x the input pixels of patch mode)")
+    return grid.ravel(), positions
+
 # ---- Shared Logic ----
 def calculate_percentages(class_indices, class_names):
     print("[DEBUG] Calculating class distribution...")
@@ -106,19 +283,50 @@ def calculate_percentages(class_indices, class_names):
     print(f"[DEBUG] Final classification percentages (sorted): {sorted_percentages}")
     return sorted_percentages
 
-def classify_image(image_path):
+def predict_class_indices(patches):
+    """Class index per patch, from the simulator or the model server."""
+    if USE_SIMULATION:
+        return simulate_classification(patches, get_class_names())
+    return classify_patches_with_model(patches)
+
+def summarize_classification(class_indices, positions, stride):
+    """Percentages and spatial class map for one image's patch predictions."""
+    if len(class_indices) == 0:
+        percentages = {}
+    else:
+        percentages = calculate_percentages(class_indices, get_class_names())
+    return {
+        "percentages": percentages,
+        "class_map": build_class_map(class_indices, positions, stride),
+        "patch_size": PATCH_SIZE,
+        "stride": stride
+    }
+
+def classify_image_detailed(image_path, stride=None):
+    """Classify an image and keep the spatial layout.
+
+    Returns ``{'percentages', 'class_map', 'patch_size', 'stride'}`` where
+    ``class_map`` is a uint8 grid of class indices aligned to patch origins
+    (``class_map.NO_PATCH`` where no patch fits), computed from the same
+    inference pass as the percentages.
+    """
     print("[DEBUG] ===== Starting image classification =====")
-    patches, positions = get_image_patches(image_path)
+    if dense_inference_enabled():
+        # Dense mode always classifies the non-overlapping patch grid
+        class_indices, positions = classify_dense_tiles(load_image(image_path))
+        return summarize_classification(class_indices, positions, PATCH_SIZE)
 
-    if not patches:
-        print("[ERROR] No patches extracted.")
-        return {}
+    stride = stride or PATCH_STRIDE
+    patches, positions = get_image_patches(image_path, stride=stride)
 
-    if USE_SIMULATION:
-        class_indices = simulate_classification(patches, class_names)
-    else:
-        class_indices = classify_patches_with_model(model, patches)
+    if len(patches) == 0:
+        print("[ERROR] No patches extracted.")
+        return summarize_classification([], positions, stride)
 
-    percentages = calculate_percentages(class_indices, class_names)
+    class_indices = predict_class_indices(patches)
+    result = summarize_classification(class_indices, positions, stride)
     print("[DEBUG] ===== Classification complete =====")
-    return percentages
+    return result
+
+def classify_image(image_path, stride=None):
+    return classify_image_detailed(image_path, stride)["percentages"]
@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class InferenceServer:
+    """Long-lived worker thread that owns the model and batches predictions.
+
+    Callers submit patch arrays from any thread. The worker blocks for the
+    first request, then keeps collecting requests until ``max_batch_size``
+    patches are queued or ``max_wait_ms`` has passed. Everything collected
+    runs through the model together and each caller gets its own rows back.
+    If the model fails to load the worker exits; every request then fails
+    with the load error and ``failed_at`` records when it happened.
+    """
+
+    def __init__(self, load_model, predict, max_batch_size=128, max_wait_ms=10):
+        self.load_model = load_model
+        self.predict_fn = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._thread = None
+        self._load_error = None
+        self._load_lock = threading.Lock()  # Orders submit() against a failed load
+        self.failed_at = None  # time.monotonic() of a failed model load
+
+    def start(self, wait=True):
+        """Start the worker (loading the model in it) and optionally wait until it is warm."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='inference-server', daemon=True)
+            self._thread.start()
+        if wait:
+            self._ready.wait()
+            if self._load_error is not None:
+                raise self._load_failure()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)  # Ignored if the worker already exited after a failed load
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, patches):
+        """Queue ``patches`` (N, H, W, C) and return a Future resolving to their predictions."""
+        future = Future()
+        with self._load_lock:
+            if self._load_error is not None:
+                future.set_exception(self._load_failure())
+            else:
+                self._queue.put((np.asarray(patches), future))
+        return future
+
+    def predict(self, patches):
+        return self.submit(patches).result()
+
+    def _collect(self, first):
+        batch, size = [first], len(first[0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # Finish this batch, stop on the next loop
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _load_failure(self):
+        return RuntimeError(f"Model failed to load: {self._load_error}")
+
+    def _run(self):
+        try:
+            model = self.load_model()
+        except Exception as e:
+            with self._load_lock:
+                self._load_error = e
+                self.failed_at = time.monotonic()
+            # Fail anything queued before the load finished; later submits fail immediately
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[1].set_exception(self._load_failure())
+            return
+        finally:
+            self._ready.set()
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = self._collect(item)
+            try:
+                patches = np.concatenate([patches for patches, _ in batch])
+                outputs = np.concatenate([
+                    self.predict_fn(model, patches[i:i + self.max_batch_size])
+                    for i in range(0, len(patches), self.max_batch_size)
+                ])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for patches, future in batch:
+                future.set_result(outputs[offset:offset + len(patches)])
+                offset += len(patches)
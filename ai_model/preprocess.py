@@ -1,8 +1,23 @@
-import cv2
 import numpy as np
 
+MODEL_INPUT_SIZE = (224, 224)
+
+def preprocess_batch(patches, size=MODEL_INPUT_SIZE, dtype='float32'):
+    """Resize a stacked (N, H, W, 3) uint8 batch in one call and fuse normalization.
+
+    ``dtype`` 'float32' or 'float16' scales to [0, 1] in that precision;
+    'uint8' keeps the 0-255 range (as the training pipeline fed EfficientNet,
+    which rescales internally) and quarters the memory traffic.
+    """
+    import tensorflow as tf
+
+    batch = tf.image.resize(np.asarray(patches), size, method='bilinear')
+    if dtype == 'uint8':
+        return tf.cast(tf.clip_by_value(tf.round(batch), 0, 255), tf.uint8)
+    return tf.cast(batch * (1.0 / 255.0), dtype)
+
 def preprocess_image(image_path):
+    import cv2
+
     image = cv2.imread(image_path)
-    image = cv2.resize(image, (64, 64))
-    image = image / 255.0
-    return np.expand_dims(image, axis=0)
\ No newline at end of file
+    return preprocess_batch(image[np.newaxis], (64, 64)).numpy()
@@ -9,7 +9,7 @@ from routes.history import history_bp
 from routes.classify import classify_bp
 from routes.imagery import imagery_bp
 from routes.auth import auth_bp
-from routes.tle_update import tle_update_bp
+from routes.fetch_tle import tle_update_bp
 from flask_cors import CORS
 from datetime import timedelta
 import os
@@ -115,6 +115,21 @@ app.register_blueprint(upload_bp, url_prefix="/api")
 from routes.classification_history import classification_history_bp
 app.register_blueprint(classification_history_bp, url_prefix="/api")
 
+# Optionally load the classifier in the background so the first request doesn't pay for it
+if os.getenv('WARM_UP_MODEL', '').lower() in ('1', 'true', 'yes'):
+    import threading
+    from ai_model.infer import warm_up
+    threading.Thread(target=warm_up, name='model-warm-up', daemon=True).start()
+
+# Keep precomputed orbit ground tracks rolling forward
+from track_store import track_store
+track_store.start_scheduler()
+
+# Refresh TLEs in the background rather than on request; workers coordinate through the database
+if os.getenv('TLE_SCHEDULER', '1').lower() not in ('0', 'false', 'no'):
+    from routes.fetch_tle import tle_scheduler
+    tle_scheduler.start()
+
 # Debugging: Print all routes
 with app.test_request_context():
     print("\n Registered API Routes:")
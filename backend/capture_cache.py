@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_CACHE_DIR = os.getenv('CAPTURE_CACHE_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'capture_cache'))
+# Total size of cached PNGs; least recently used captures are evicted beyond it. 0 disables caching
+CAPTURE_CACHE_MAX_BYTES = int(float(os.getenv('CAPTURE_CACHE_MAX_MB', 512)) * 1024 * 1024)
+# Geohash length captures are snapped to; 7 characters is a ~153 m x 153 m cell
+GEOHASH_PRECISION = int(os.getenv('CAPTURE_GEOHASH_PRECISION', 7))
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+KEY_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+NAME_PATTERN = re.compile(r'^[a-z_]+$')
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coordinate >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def geohash_bounds(geohash):
+    """``(min_lat, min_lon, max_lat, max_lon)`` of a geohash cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if value >> shift & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def snap_to_cell(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Geohash of the cell containing a point, and the cell's center (lat, lon)."""
+    geohash = geohash_encode(latitude, longitude, precision)
+    min_lat, min_lon, max_lat, max_lon = geohash_bounds(geohash)
+    return geohash, (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+
+class CaptureCache:
+    """Captured PNGs on disk, one directory per capture key, evicted least recently used first.
+
+    A directory's mtime is its last use, so the cache survives restarts and
+    is shared by every worker pointing at the same directory.
+    """
+
+    def __init__(self, directory=CAPTURE_CACHE_DIR, max_bytes=CAPTURE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(*parts):
+        """Cache key for a deterministic capture query, e.g. dataset, date window and geohash."""
+        return hashlib.sha1('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def path(self, key, name):
+        """Path of one cached PNG, or None for malformed keys/names."""
+        if not KEY_PATTERN.match(key) or not NAME_PATTERN.match(name):
+            return None
+        return os.path.join(self.directory, key, f"{name}.png")
+
+    def get(self, key, names):
+        """Paths of the cached ``names`` PNGs for ``key``, or None unless all are present."""
+        entry_dir = os.path.join(self.directory, key)
+        paths = {name: self.path(key, name) for name in names}
+        if not all(p and os.path.exists(p) for p in paths.values()):
+            return None
+        try:
+            os.utime(entry_dir)  # Mark as recently used
+        except OSError:
+            return None  # Evicted meanwhile
+        return paths
+
+    def put(self, key, images):
+        """Store ``{name: png_bytes}`` under ``key`` and return their paths."""
+        os.makedirs(self.directory, exist_ok=True)
+        staging = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(staging)
+        for name, data in images.items():
+            with open(os.path.join(staging, f"{name}.png"), 'wb') as f:
+                f.write(data)
+
+        entry_dir = os.path.join(self.directory, key)
+        with self._lock:
+            try:
+                os.replace(staging, entry_dir)
+            except OSError:
+                # Stored meanwhile, e.g. by another worker capturing the same cell;
+                # keep a complete entry, replace an incomplete one
+                if self.get(key, images) is None:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    try:
+                        os.replace(staging, entry_dir)
+                    except OSError:
+                        pass  # Lost the race again; the other worker's entry stands
+                shutil.rmtree(staging, ignore_errors=True)
+            self._evict(keep=key)
+        return {name: self.path(key, name) for name in images}
+
+    def _entries(self):
+        """``(last_used, size, path)`` per cached capture."""
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, name)
+            if not KEY_PATTERN.match(name) or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+            except OSError:
+                continue
+        return entries
+
+    def _evict(self, keep=None):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            if os.path.basename(entry_dir) == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logger.info(f"Evicted capture cache entry {os.path.basename(entry_dir)}")
+
+
+capture_cache = CaptureCache()
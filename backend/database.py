@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import logging
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db")  # Default SQLite
@@ -9,6 +10,66 @@ engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} i
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def add_missing_columns():
+    """Add model columns that existing tables predate (create_all only creates tables)."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def add_missing_indexes():
+    """Create model indexes that existing tables predate, rebuilding any whose uniqueness changed."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {ix['name']: bool(ix['unique']) for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing and existing[index.name] != bool(index.unique):
+                    index.drop(bind=conn)
+                    del existing[index.name]
+                if index.name not in existing:
+                    index.create(bind=conn)
+
+def dedupe_satellites():
+    """Keep one row per NORAD id, the newest element set, so the unique norad_id index can be built."""
+    if not inspect(engine).has_table('cubesat_positions'):
+        return
+    with engine.begin() as conn:
+        removed = conn.execute(text(
+            'DELETE FROM cubesat_positions WHERE norad_id IS NOT NULL AND id NOT IN ('
+            'SELECT id FROM (SELECT id, ROW_NUMBER() OVER ('
+            'PARTITION BY norad_id ORDER BY epoch IS NULL, epoch DESC, id DESC) AS n '
+            'FROM cubesat_positions WHERE norad_id IS NOT NULL) AS ranked WHERE n = 1)'
+        )).rowcount
+    if removed:
+        logging.info(f"Removed {removed} duplicate satellite rows")
+
+def backfill_tle_elements():
+    """Parse the TLE element columns for rows stored before they existed."""
+    from models import CubeSat
+    from propagation import tle_elements
+
+    session = SessionLocal()
+    try:
+        rows = session.query(CubeSat.id, CubeSat.line1, CubeSat.line2).filter(CubeSat.norad_id.is_(None)).all()
+        if rows:
+            session.execute(update(CubeSat), [dict(tle_elements(r.line1, r.line2), id=r.id) for r in rows])
+            session.commit()
+    finally:
+        session.close()
+
 def init_db():
-    from models import CubeSat, ImageHistory, Classification, User, UploadedImage
+    from models import CubeSat, ImageHistory, Classification, User, UploadedImage, TleSourceState, Job
     Base.metadata.create_all(bind=engine, checkfirst=True)
+    add_missing_columns()
+    backfill_tle_elements()
+    dedupe_satellites()
+    add_missing_indexes()
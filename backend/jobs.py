@@ -0,0 +1,108 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from database import SessionLocal
+from models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_MAX_QUEUED = int(os.getenv('JOB_MAX_QUEUED', 100))  # Unfinished jobs per process before submit() refuses
+JOB_RETENTION_SECONDS = 3600  # Finished jobs are forgotten after this long
+
+
+class JobQueueFull(Exception):
+    """Raised by JobQueue.submit() when JOB_MAX_QUEUED jobs are already waiting or running."""
+
+
+class JobQueue:
+    """Background jobs run on this process's thread pool, tracked by id for polling.
+
+    Job state lives in the ``jobs`` table, so a poll answered by any worker
+    process sees it. Results must be JSON serializable.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, retention_seconds=JOB_RETENTION_SECONDS,
+                 max_queued=JOB_MAX_QUEUED):
+        self.retention_seconds = retention_seconds
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._unfinished = 0
+
+    def submit(self, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)`` and return the new job id; raises JobQueueFull when full."""
+        with self._lock:
+            if self._unfinished >= self.max_queued:
+                raise JobQueueFull(f"{self._unfinished} jobs already queued")
+            self._unfinished += 1
+        try:
+            self._prune()
+            job_id = str(uuid.uuid4())
+            self._write(lambda session: session.add(Job(id=job_id, status="queued")))
+            self._executor.submit(self._run, job_id, func, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._unfinished -= 1
+            raise
+        return job_id
+
+    def _run(self, job_id, func, args, kwargs):
+        try:
+            self._update(job_id, status="running", started=datetime.datetime.utcnow())
+            result = json.dumps(func(*args, **kwargs))
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            fields = {"status": "failed", "error": str(e)}
+        else:
+            fields = {"status": "finished", "result": result}
+        finally:
+            with self._lock:
+                self._unfinished -= 1  # Before the final state, so a finished job has freed its slot
+        try:
+            self._update(job_id, finished=datetime.datetime.utcnow(), **fields)
+        except Exception as e:
+            logger.error(f"Could not record the state of job {job_id}: {e}")
+
+    @staticmethod
+    def _write(change):
+        session = SessionLocal()
+        try:
+            change(session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _update(self, job_id, **fields):
+        self._write(lambda session: session.query(Job).filter(Job.id == job_id).update(fields))
+
+    def _prune(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention_seconds)
+        self._write(lambda session: session.query(Job).filter(Job.finished < cutoff).delete())
+
+    def get(self, job_id):
+        """Snapshot of a job's state, or None if unknown."""
+        session = SessionLocal()
+        try:
+            job = session.get(Job, job_id)
+            if job is None:
+                return None
+            return {
+                "id": job.id,
+                "status": job.status,
+                "created": job.created,
+                "started": job.started,
+                "finished": job.finished,
+                "result": json.loads(job.result) if job.result is not None else None,
+                "error": job.error
+            }
+        finally:
+            session.close()
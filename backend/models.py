@@ -1,8 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy import Column, Integer, String, Float, Text, DateTime
 from database import Base
-from sgp4.api import Satrec
+from propagation import compute_positions
 from datetime import datetime
-from math import degrees, atan2, sqrt, pi
 from werkzeug.security import generate_password_hash, check_password_hash
 
 class CubeSat(Base):
@@ -10,42 +9,20 @@ class CubeSat(Base):
     __table_args__ = {'extend_existing': True}
 
     id = Column(Integer, primary_key=True)
-    satellite = Column(String, nullable=False)
+    satellite = Column(String, nullable=False, index=True)  # Not unique: e.g. "OBJECT A" names many objects
     line1 = Column(String, nullable=False)
     line2 = Column(String, nullable=False)
+    # Parsed from the TLE at ingest (see propagation.tle_elements) for SQL-side filtering
+    norad_id = Column(Integer, nullable=True, unique=True, index=True)  # Upsert key for TLE refreshes
+    epoch = Column(DateTime, nullable=True, index=True)  # TLE epoch (UTC); older element sets are not applied
+    inclination = Column(Float, nullable=True, index=True)  # Degrees
+    eccentricity = Column(Float, nullable=True)
+    mean_motion = Column(Float, nullable=True, index=True)  # Revolutions per day
 
     def compute_position(self):
         """Convert TLE to lat, lon, and alt using SGP4."""
         try:
-            from sgp4.ext import jday
-            satellite = Satrec.twoline2rv(self.line1, self.line2)
-            now = datetime.utcnow()
-            jd_full = jday(now.year, now.month, now.day, now.hour, now.minute, now.second + now.microsecond * 1e-6)
-            jd = int(jd_full)
-            fr = jd_full - jd
-            raw_result = satellite.sgp4(jd, fr)  # Get position in ECI coordinates (km)
-
-            if not (isinstance(raw_result, tuple) and len(raw_result) == 3):
-                return None, None, None
-
-            e, pos, vel = raw_result
-
-            if e != 0:
-                return None, None, None  # Error in calculation
-
-            if not (isinstance(pos, (tuple, list)) and len(pos) == 3):
-                return None, None, None
-
-            # Convert ECI to lat/lon/alt
-            x, y, z = pos  # ECI coordinates (km)
-            earth_radius = 6371  # Earth's radius (km)
-
-            lat = degrees(atan2(z, sqrt(x**2 + y**2)))
-            lon = degrees(atan2(y, x))
-            alt = sqrt(x**2 + y**2 + z**2) - earth_radius  # Altitude in km
-
-            result = (round(lat, 6), round(lon, 6), round(alt, 2))  # Limit decimal places
-            return result
+            return compute_positions([self])[0]
         except Exception as e:
             return None, None, None
 
@@ -98,6 +75,9 @@ class Classification(Base):
     image_url = Column(String, nullable=False)
     classification = Column(String, nullable=False)
     confidence = Column(Float, nullable=False)
+    content_hash = Column(String(64), nullable=True, index=True)  # SHA-256 of the image bytes
+    cache_key = Column(String(64), nullable=True, index=True)  # content hash + model/patch config
+    class_map = Column(Text, nullable=True)  # JSON run-length encoded per-patch class grid
 
     def to_dict(self):
         return {"id": self.id, "image_url": self.image_url, "classification": self.classification, "confidence": self.confidence}
@@ -126,3 +106,26 @@ class UploadedImage(Base):
     image_url = Column(String, nullable=False)
     upload_time = Column(DateTime, default=datetime.utcnow)
 
+class TleSourceState(Base):
+    """Conditional-fetch state for a TLE source, so unchanged feeds are not re-downloaded or re-applied."""
+    __tablename__ = "tle_source_state"
+    __table_args__ = {'extend_existing': True}
+    id = Column(Integer, primary_key=True)
+    url = Column(String, unique=True, nullable=False)
+    etag = Column(String, nullable=True)
+    last_modified = Column(String, nullable=True)
+    content_hash = Column(String(64), nullable=True)  # SHA-256 of the last applied feed
+    last_checked = Column(DateTime, nullable=True)
+    last_updated = Column(DateTime, nullable=True)
+
+class Job(Base):
+    """Asynchronous job state (see jobs.JobQueue), stored here so any worker process can report it."""
+    __tablename__ = "jobs"
+    __table_args__ = {'extend_existing': True}
+    id = Column(String(36), primary_key=True)
+    status = Column(String(16), nullable=False)  # queued/running/finished/failed
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started = Column(DateTime, nullable=True)
+    finished = Column(DateTime, nullable=True, index=True)
+    result = Column(Text, nullable=True)  # JSON
+    error = Column(Text, nullable=True)
@@ -0,0 +1,256 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+from sgp4.api import Satrec, SatrecArray, jday
+
+logger = logging.getLogger(__name__)
+
+# Columnar orbit tracks: ``offsets`` are minutes after ``start``; ``lat``,
+# ``lon``, ``alt`` and ``ok`` have shape (len(index), len(offsets)) and
+# ``index`` maps each track back to its position in the input rows.
+Tracks = namedtuple('Tracks', 'start offsets index lat lon alt ok')
+
+# WGS84 ellipsoid (km)
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+
+def tle_digest(line1, line2):
+    """Stable hash of a TLE's two lines."""
+    return hashlib.sha1(f"{line1}\n{line2}".encode()).hexdigest()
+
+
+def tle_epoch(line1):
+    """UTC epoch (naive datetime) from TLE line 1, or None if malformed."""
+    try:
+        year, day = int(line1[18:20]), float(line1[20:32])
+    except (TypeError, ValueError):
+        return None
+    year += 2000 if year < 57 else 1900
+    return datetime(year, 1, 1) + timedelta(days=day - 1)
+
+
+# Alpha-5 leading letters (I and O skipped) for catalog numbers of 100000 and up
+ALPHA5_LETTERS = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
+
+
+def norad_number(field):
+    """Catalog number from the 5-character TLE field, decoding Alpha-5 (e.g. 'A0000' = 100000)."""
+    field = field.strip()
+    if field[:1].isalpha():
+        return (ALPHA5_LETTERS.index(field[0].upper()) + 10) * 10000 + int(field[1:])
+    return int(field)
+
+
+def tle_elements(line1, line2):
+    """Typed fields of a TLE, as stored on CubeSat; any that fail to parse are None.
+
+    Keys: norad_id, epoch, inclination (deg), eccentricity, mean_motion (rev/day).
+    """
+    def parse(func, *args):
+        try:
+            return func(*args)
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    return {
+        "norad_id": parse(norad_number, line1[2:7]),
+        "epoch": tle_epoch(line1),
+        "inclination": parse(float, line2[8:16]),
+        "eccentricity": parse(lambda field: float(f"0.{field.strip()}"), line2[26:33]),
+        "mean_motion": parse(float, line2[52:63])
+    }
+
+
+class SatrecCache:
+    """Process-wide cache of parsed TLEs.
+
+    Entries are keyed by satellite id plus a hash of the TLE lines, so a row
+    whose lines change is simply re-parsed on next use. Combined SatrecArrays
+    are kept for the most recently requested satellite sets and rebuilt from
+    the per-satellite records, which means only changed TLEs are re-parsed.
+    """
+
+    def __init__(self, max_arrays=8):
+        self.max_arrays = max_arrays
+        self._lock = threading.Lock()
+        self._satrecs = {}
+        self._arrays = OrderedDict()
+
+    @staticmethod
+    def _key(row):
+        sat_id = getattr(row, 'id', None)
+        if sat_id is None:
+            sat_id = row.satellite
+        return sat_id, tle_digest(row.line1, row.line2)
+
+    def _parse(self, key, row):
+        satrec = self._satrecs.get(key[0])
+        if satrec is not None and satrec[0] == key[1]:
+            return satrec[1]
+        try:
+            parsed = Satrec.twoline2rv(row.line1, row.line2)
+        except Exception as e:
+            logger.warning(f"Skipping satellite {row.satellite}: invalid TLE ({e})")
+            parsed = None
+        self._satrecs[key[0]] = (key[1], parsed)
+        return parsed
+
+    def satrec(self, row):
+        """Parsed Satrec for ``row``, or None if its TLE is invalid."""
+        key = self._key(row)
+        with self._lock:
+            return self._parse(key, row)
+
+    def satrec_array(self, rows):
+        """SatrecArray for ``rows`` plus the positions in ``rows`` it covers."""
+        keys = tuple(self._key(row) for row in rows)
+        with self._lock:
+            cached = self._arrays.get(keys)
+            if cached is not None:
+                self._arrays.move_to_end(keys)
+                return cached
+
+            satrecs, index = [], []
+            for i, (key, row) in enumerate(zip(keys, rows)):
+                parsed = self._parse(key, row)
+                if parsed is not None:
+                    satrecs.append(parsed)
+                    index.append(i)
+
+            if satrecs:
+                cached = SatrecArray(satrecs), np.asarray(index, dtype=np.intp)
+            else:
+                cached = None, np.empty(0, dtype=np.intp)
+            self._arrays[keys] = cached
+            while len(self._arrays) > self.max_arrays:
+                self._arrays.popitem(last=False)
+            return cached
+
+    def invalidate(self, sat_ids=None):
+        """Drop cached records for ``sat_ids`` (everything when None)."""
+        with self._lock:
+            if sat_ids is None:
+                self._satrecs.clear()
+                self._arrays.clear()
+                return
+            sat_ids = set(sat_ids)
+            for sat_id in sat_ids:
+                self._satrecs.pop(sat_id, None)
+            for keys in [k for k in self._arrays if any(key[0] in sat_ids for key in k)]:
+                del self._arrays[keys]
+
+
+satrec_cache = SatrecCache()
+
+
+def build_satrec_array(rows):
+    """Parse the TLEs of ``rows`` into a SatrecArray.
+
+    Returns ``(satrec_array, index)`` where ``index`` holds the positions in
+    ``rows`` that parsed successfully, in the order of the array.
+    """
+    return satrec_cache.satrec_array(rows)
+
+
+def julian_dates(times):
+    """Split datetimes into the (jd, fr) float arrays expected by SGP4."""
+    jd, fr = np.empty(len(times)), np.empty(len(times))
+    for i, t in enumerate(times):
+        jd[i], fr[i] = jday(t.year, t.month, t.day, t.hour, t.minute,
+                            t.second + t.microsecond * 1e-6)
+    return jd, fr
+
+
+def time_grid(start, duration_days=1, interval_minutes=10):
+    """Evenly spaced (jd, fr) arrays starting at ``start`` plus their minute offsets."""
+    offsets = np.arange(0, duration_days * 24 * 60, interval_minutes, dtype=float)
+    jd0, fr0 = julian_dates([start])
+    return np.full(offsets.shape, jd0[0]), fr0[0] + offsets / 1440.0, offsets
+
+
+def gmst(jd, fr):
+    """Greenwich mean sidereal time (radians), IAU-82 as used by SGP4."""
+    tut1 = ((jd - 2451545.0) + fr) / 36525.0
+    seconds = (-6.2e-6 * tut1 ** 3 + 0.093104 * tut1 ** 2
+               + (876600.0 * 3600 + 8640184.812866) * tut1 + 67310.54841)
+    return np.mod(np.radians(seconds / 240.0), 2 * np.pi)
+
+
+def teme_to_geodetic(r, jd, fr):
+    """Convert TEME positions (km) to WGS84 latitude, longitude (degrees) and altitude (km).
+
+    ``r`` has shape ``(..., n_times, 3)`` and ``jd``/``fr`` shape ``(n_times,)``.
+    """
+    theta = gmst(jd, fr)
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    x_teme, y_teme, z = r[..., 0], r[..., 1], r[..., 2]
+
+    # Rotate into the Earth-fixed frame (polar motion ignored)
+    x = cos_t * x_teme + sin_t * y_teme
+    y = -sin_t * x_teme + cos_t * y_teme
+
+    p = np.hypot(x, y)
+    lon = np.arctan2(y, x)
+    lat = np.arctan2(z, p * (1 - WGS84_E2))
+    for _ in range(3):
+        sin_lat = np.sin(lat)
+        n = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_lat ** 2)
+        lat = np.arctan2(z + n * WGS84_E2 * sin_lat, p)
+    sin_lat = np.sin(lat)
+    alt = p * np.cos(lat) + z * sin_lat - WGS84_A * np.sqrt(1 - WGS84_E2 * sin_lat ** 2)
+
+    return np.degrees(lat), np.degrees(lon), alt
+
+
+def propagate_geodetic(satrec_array, jd, fr):
+    """Propagate every satellite over every time in one call.
+
+    Returns ``(lat, lon, alt, ok)`` arrays of shape ``(n_sats, n_times)``;
+    ``ok`` is False where SGP4 reported an error.
+    """
+    e, r, _ = satrec_array.sgp4(jd, fr)
+    lat, lon, alt = teme_to_geodetic(r, jd, fr)
+    ok = (e == 0) & np.isfinite(alt)
+    return lat, lon, alt, ok
+
+
+def positions_at(satrec_array, when=None):
+    """Current geodetic position of every satellite in ``satrec_array``."""
+    when = when or datetime.utcnow()
+    jd, fr = julian_dates([when])
+    lat, lon, alt, ok = propagate_geodetic(satrec_array, jd, fr)
+    return lat[:, 0], lon[:, 0], alt[:, 0], ok[:, 0]
+
+
+def compute_positions(rows, when=None):
+    """Propagate ``rows`` (CubeSat records) to ``when`` as a single batch.
+
+    Returns a list aligned with ``rows`` of ``(lat, lon, alt)`` tuples, with
+    ``(None, None, None)`` for satellites that failed to parse or propagate.
+    """
+    results = [(None, None, None)] * len(rows)
+    satrec_array, index = build_satrec_array(rows)
+    if satrec_array is None:
+        return results
+    lat, lon, alt, ok = positions_at(satrec_array, when)
+    for k in np.flatnonzero(ok):
+        results[index[k]] = (round(float(lat[k]), 6), round(float(lon[k]), 6), round(float(alt[k]), 2))
+    return results
+
+
+def compute_tracks(rows, start=None, duration_days=1, interval_minutes=10):
+    """Ground tracks of ``rows`` over a time window, propagated as one array call."""
+    start = start or datetime.utcnow()
+    jd, fr, offsets = time_grid(start, duration_days, interval_minutes)
+    satrec_array, index = build_satrec_array(rows)
+    if satrec_array is None or not len(offsets):
+        empty = np.empty((0, len(offsets)))
+        return Tracks(start, offsets, index, empty, empty, empty, empty.astype(bool))
+    lat, lon, alt, ok = propagate_geodetic(satrec_array, jd, fr)
+    return Tracks(start, offsets, index, lat, lon, alt, ok)
@@ -1,90 +1,413 @@
+import ast
+import hashlib
+import json
 import sys
 import os
 import requests
 import uuid
-from flask import Blueprint, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from flask import Blueprint, request, jsonify, url_for
+from sqlalchemy import insert
 from sqlalchemy.orm import sessionmaker
 from database import engine
 from models import Classification, ImageHistory, UploadedImage
-from ai_model.infer import classify_image
+from ai_model.infer import (PATCH_STRIDE, classify_image_detailed, dense_inference_enabled, get_class_names,
+                             get_image_patches, model_signature, predict_class_indices, summarize_classification)
+from ai_model.class_map import MAP_ENCODINGS, NO_PATCH, encode_class_map, rle_decode, rle_encode
+from jobs import JobQueue, JobQueueFull
 import base64
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 classify_bp = Blueprint('classify', __name__)
 Session = sessionmaker(bind=engine)
+classify_jobs = JobQueue()
+
+MAX_BATCH_IMAGES = 100
+JOB_RETRY_AFTER_SECONDS = 5  # Retry-After sent when the job queue is full
+BATCH_LOAD_WORKERS = 8  # Threads downloading/tiling images for a batch
+# Batch items naming a stored image, e.g. {"history_id": 12} or {"upload_id": 7}
+IMAGE_ID_SOURCES = {'history_id': ImageHistory, 'upload_id': UploadedImage}
+
+class ClassificationError(Exception):
+    """Request-level failure carrying the HTTP status to report."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+def resolve_image(image_url):
+    """Download remote images and locate the file on disk.
+
+    Returns ``(image_url, image_path)`` where ``image_url`` is the value stored
+    in the DB (relative for downloaded images).
+    """
+    # Check if image_url is remote URL
+    if image_url.startswith('http://') or image_url.startswith('https://'):
+        # Download image and save to backend/static/images
+        response = requests.get(image_url)
+        if response.status_code != 200:
+            raise ClassificationError("Failed to download image from URL", 400)
+
+        image_id = str(uuid.uuid4())
+        image_filename = f"{image_id}.png"
+        full_image_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static', 'images',
+                                                       image_filename))
+        os.makedirs(os.path.dirname(full_image_path), exist_ok=True)
+        with open(full_image_path, 'wb') as f:
+            f.write(response.content)
+
+        # Update image_url to the path relative to static/ for DB and classification
+        image_url = os.path.join('images', image_filename)
+
+    # Construct local file path from image_url
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    # Normalize path separators to handle mixed slashes
+    normalized_image_url = image_url.replace('/', os.sep).replace('\\', os.sep)
+    image_path_static = os.path.join(base_dir, 'static', normalized_image_url)
+    image_path_uploads = os.path.join(base_dir, 'static', 'uploads', os.path.basename(normalized_image_url))
+
+    print(f"Checking image file path in static: {image_path_static}")  # Debug log
+    print(f"Checking image file path in uploads: {image_path_uploads}")  # Debug log
+    file_exists_static = os.path.exists(image_path_static)
+    file_exists_uploads = os.path.exists(image_path_uploads)
+    print(f"Image file exists in static: {file_exists_static}")  # Debug log
+    print(f"Image file exists in uploads: {file_exists_uploads}")  # Debug log
+
+    if file_exists_static:
+        return image_url, image_path_static
+    if file_exists_uploads:
+        return image_url, image_path_uploads
+    raise ClassificationError("Image file not found on server", 404)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def classification_cache_key(content_hash):
+    """Key for cached results: image content plus everything that affects the model output."""
+    return hashlib.sha256(f"{content_hash}|{model_signature()}".encode()).hexdigest()
+
+def find_cached_classification(session, cache_key, need_map=False):
+    query = session.query(Classification).filter(Classification.cache_key == cache_key)
+    if need_map:
+        query = query.filter(Classification.class_map.isnot(None))
+    return query.order_by(Classification.id.desc()).first()
+
+def class_map_payload(rle_map, encoding):
+    grid = rle_decode(rle_map)
+    payload = encode_class_map(grid, encoding)
+    payload.update({
+        "encoding": encoding,
+        "classes": get_class_names(),
+        "no_patch": NO_PATCH,
+        "patch_size": rle_map.get("patch_size"),
+        "stride": rle_map.get("stride")
+    })
+    return payload
+
+def cached_result(cached, include_map, map_encoding):
+    result = {
+        "classification_percentages": ast.literal_eval(cached.classification),
+        "cached": True
+    }
+    if include_map:
+        result["class_map"] = class_map_payload(json.loads(cached.class_map), map_encoding)
+    return result
+
+def classification_values(image_url, content_hash, cache_key, detailed):
+    """Column values for a new Classification row plus the RLE map stored in it."""
+    rle_map = rle_encode(detailed["class_map"])
+    rle_map.update({"patch_size": list(detailed["patch_size"]), "stride": list(detailed["stride"])})
+    percentages = detailed["percentages"]
+    values = {
+        "image_url": image_url,
+        "classification": str(percentages),
+        "confidence": max(percentages.values(), default=0.0),
+        "content_hash": content_hash,
+        "cache_key": cache_key,
+        "class_map": json.dumps(rle_map)
+    }
+    return values, rle_map
+
+def classification_result(percentages, rle_map, include_map, map_encoding):
+    result = {
+        "classification_percentages": percentages
+    }
+    if include_map:
+        result["class_map"] = class_map_payload(rle_map, map_encoding)
+    return result
+
+def run_classification(image_url, include_map=False, map_encoding='rle'):
+    """Classify one image and store the result; returns the response payload.
+
+    With ``include_map`` the per-patch class grid is returned as well, encoded
+    with ``map_encoding`` (see ``ai_model.class_map.MAP_ENCODINGS``).
+    """
+    requested_url = image_url
+    image_url, image_path = resolve_image(image_url)
+    content_hash = file_sha256(image_path)
+    cache_key = classification_cache_key(content_hash)
+
+    session = Session()
+    try:
+        cached = find_cached_classification(session, cache_key, need_map=include_map)
+        if cached is not None:
+            print(f"Classification cache hit for {content_hash}")
+            if image_url != requested_url:
+                os.remove(image_path)  # Drop the duplicate download
+            return cached_result(cached, include_map, map_encoding)
+
+        # Call the AI model inference function
+        detailed = classify_image_detailed(image_path)
+        print(f"Classification percentages from model: {detailed['percentages']}")
+
+        # Store classification result in DB
+        values, rle_map = classification_values(image_url, content_hash, cache_key, detailed)
+        session.add(Classification(**values))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return classification_result(detailed["percentages"], rle_map, include_map, map_encoding)
+
+def batch_image_url(session, image):
+    """Image URL/path for a batch item: a URL/path or an id keyed by its source (see IMAGE_ID_SOURCES)."""
+    if isinstance(image, str):
+        return image
+    if not isinstance(image, dict) or len(image) != 1 or next(iter(image)) not in IMAGE_ID_SOURCES:
+        raise ClassificationError('Images must be URLs/paths, {"history_id": n} or {"upload_id": n}', 400)
+    source, image_id = next(iter(image.items()))
+    model = IMAGE_ID_SOURCES[source]
+    row = session.query(model).filter(model.id == image_id).first()
+    if row is None:
+        raise ClassificationError(f"Image {source} {image_id} not found", 404)
+    return row.image_url
+
+def load_batch_image(image_url):
+    """Resolve and hash one batch image; errors are returned rather than raised."""
+    try:
+        local_url, image_path = resolve_image(image_url)
+        content_hash = file_sha256(image_path)
+    except Exception as e:
+        return {"error": e}
+    return {
+        "image_url": local_url,
+        "image_path": image_path,
+        "downloaded": local_url != image_url,
+        "content_hash": content_hash,
+        "cache_key": classification_cache_key(content_hash)
+    }
+
+def error_result(image_url, error):
+    return {"image_url": image_url, "error": str(error), "status": getattr(error, 'status', 500)}
+
+def attempt_image(func, image_path, **kwargs):
+    """``func(image_path)``, or the exception it raised, so one bad image does not fail a batch."""
+    try:
+        return func(image_path, **kwargs)
+    except OSError as e:  # Includes PIL's UnidentifiedImageError and truncated files
+        return ClassificationError(f"Could not read image: {e}", 400)
+    except Exception as e:
+        return e
+
+def classify_batch_paths(paths):
+    """Detailed classification per image path, pooling patches into shared inference batches.
+
+    Images that cannot be read get their exception in place of a result.
+    """
+    if dense_inference_enabled():
+        # Dense inference works on whole images, so there are no patches to pool
+        return [attempt_image(classify_image_detailed, path) for path in paths]
+
+    # Tile concurrently, then run every patch through shared inference batches
+    with ThreadPoolExecutor(max_workers=BATCH_LOAD_WORKERS) as pool:
+        tiles = list(pool.map(lambda path: attempt_image(get_image_patches, path, stride=PATCH_STRIDE), paths))
+    readable = [tile for tile in tiles if not isinstance(tile, Exception)]
+    if not readable:
+        return tiles
+    counts = [len(patches) for patches, _ in readable]
+    all_patches = np.concatenate([patches for patches, _ in readable])
+    class_indices = predict_class_indices(all_patches) if len(all_patches) else []
+    splits = iter(np.split(np.asarray(class_indices, dtype=int), np.cumsum(counts)[:-1]))
+    return [tile if isinstance(tile, Exception) else summarize_classification(next(splits), tile[1], PATCH_STRIDE)
+            for tile in tiles]
+
+def run_batch_classification(images, include_map=False, map_encoding='rle'):
+    """Classify several images with shared inference batches and one bulk insert.
+
+    ``images`` holds image URLs/paths and ``{"history_id": n}``/``{"upload_id": n}``
+    references. Returns one result per input, in order; repeated images
+    (same URL or same content) are inferred and stored once.
+    """
+    results = [None] * len(images)
+    session = Session()
+    try:
+        urls = []
+        for i, image in enumerate(images):
+            try:
+                urls.append(batch_image_url(session, image))
+            except ClassificationError as e:
+                urls.append(None)
+                results[i] = error_result(image, e)
+
+        # Download, locate and hash each distinct URL once, concurrently
+        unique_urls = list(dict.fromkeys(url for url in urls if url))
+        with ThreadPoolExecutor(max_workers=BATCH_LOAD_WORKERS) as pool:
+            loaded_by_url = dict(zip(unique_urls, pool.map(load_batch_image, unique_urls)))
+        loaded = [loaded_by_url[url] if url else None for url in urls]
+
+        for i, item in enumerate(loaded):
+            if item is not None and "error" in item:
+                results[i] = error_result(urls[i], item["error"])
+                loaded[i] = None
+
+        # One query for every cache key in the batch
+        keys = {item["cache_key"] for item in loaded if item}
+        query = session.query(Classification).filter(Classification.cache_key.in_(keys))
+        if include_map:
+            query = query.filter(Classification.class_map.isnot(None))
+        cached_by_key = {c.cache_key: c for c in query.order_by(Classification.id).all()}
+
+        pending = {}  # cache_key -> indices of the images to classify
+        dropped = set()
+
+        def drop_download(item):
+            if item["downloaded"] and item["image_path"] not in dropped:
+                os.remove(item["image_path"])
+                dropped.add(item["image_path"])
+
+        for i, item in enumerate(loaded):
+            if item is None:
+                continue
+            cached = cached_by_key.get(item["cache_key"])
+            if cached is None:
+                pending.setdefault(item["cache_key"], []).append(i)
+                continue
+            drop_download(item)  # Duplicate of an already classified image
+            image_url = cached.image_url if item["downloaded"] else item["image_url"]
+            results[i] = dict(cached_result(cached, include_map, map_encoding), image_url=image_url)
+
+        groups = list(pending.values())
+        for indices in groups:
+            # Same content under several URLs: classify and keep the first copy only
+            kept = loaded[indices[0]]
+            for i in indices[1:]:
+                if loaded[i]["image_path"] != kept["image_path"]:
+                    drop_download(loaded[i])
+                    loaded[i] = dict(loaded[i], image_url=kept["image_url"], image_path=kept["image_path"])
+
+        details = classify_batch_paths([loaded[indices[0]]["image_path"] for indices in groups])
+
+        rows = []
+        for indices, detailed in zip(groups, details):
+            item = loaded[indices[0]]
+            if isinstance(detailed, Exception):
+                drop_download(item)
+                for i in indices:
+                    results[i] = error_result(urls[i], detailed)
+                continue
+            values, rle_map = classification_values(item["image_url"], item["content_hash"],
+                                                    item["cache_key"], detailed)
+            rows.append(values)
+            result = classification_result(detailed["percentages"], rle_map, include_map, map_encoding)
+            for i in indices:
+                results[i] = dict(result, image_url=loaded[i]["image_url"])
+
+        if rows:
+            session.execute(insert(Classification), rows)
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return results
+
+def map_options(data):
+    """Validated ``include_map``/``map_encoding`` request options."""
+    map_encoding = data.get('map_encoding', 'rle')
+    if map_encoding not in MAP_ENCODINGS:
+        raise ClassificationError(f"map_encoding must be one of {list(MAP_ENCODINGS)}", 400)
+    return bool(data.get('include_map')), map_encoding
+
+def queue_job(func, *args):
+    """Queue ``func(*args)`` as a classification job: 202 with its id, or 503 when the queue is full."""
+    try:
+        job_id = classify_jobs.submit(func, *args)
+    except JobQueueFull as e:
+        return jsonify({"error": f"Too many classification jobs queued ({e}); retry later"}), 503, \
+            {"Retry-After": str(JOB_RETRY_AFTER_SECONDS)}
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": url_for('classify.get_classify_job', job_id=job_id)
+    }), 202
 
 @classify_bp.route('/classify_image', methods=['POST'])
 def classify_image_route():
+    """Classify an image; with ``"async": true`` queue a job and return its id immediately."""
     data = request.get_json()
     image_url = data.get('image_url')
     print(f"Received classify request for image_url: {image_url}")  # Debug log
     if not image_url:
         return jsonify({"error": "No image_url provided"}), 400
 
-    session = Session()
     try:
-        # Check if image_url is remote URL
-        if image_url.startswith('http://') or image_url.startswith('https://'):
-            # Download image and save to backend/static/images
-            response = requests.get(image_url)
-            if response.status_code != 200:
-                return jsonify({"error": "Failed to download image from URL"}), 400
-
-            image_id = str(uuid.uuid4())
-            image_filename = f"{image_id}.png"
-            image_path = os.path.join('static', 'images', image_filename)
-            full_image_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', image_path))
-            os.makedirs(os.path.dirname(full_image_path), exist_ok=True)
-            with open(full_image_path, 'wb') as f:
-                f.write(response.content)
-
-            # Update image_url to relative path for DB and classification
-            image_url = image_path
-
-        # Construct local file path from image_url
-        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        # Normalize path separators to handle mixed slashes
-        normalized_image_url = image_url.replace('/', os.sep).replace('\\', os.sep)
-        image_path_static = os.path.join(base_dir, 'static', normalized_image_url)
-        image_path_uploads = os.path.join(base_dir, 'static', 'uploads', os.path.basename(normalized_image_url))
-
-        print(f"Checking image file path in static: {image_path_static}")  # Debug log
-        print(f"Checking image file path in uploads: {image_path_uploads}")  # Debug log
-        file_exists_static = os.path.exists(image_path_static)
-        file_exists_uploads = os.path.exists(image_path_uploads)
-        print(f"Image file exists in static: {file_exists_static}")  # Debug log
-        print(f"Image file exists in uploads: {file_exists_uploads}")  # Debug log
-
-        if file_exists_static:
-            image_path = image_path_static
-        elif file_exists_uploads:
-            image_path = image_path_uploads
-        else:
-            return jsonify({"error": "Image file not found on server"}), 404
-
-        # Call the AI model inference function
-        classification_percentages = classify_image(image_path)
-        print(f"Classification percentages from model: {classification_percentages}")
+        include_map, map_encoding = map_options(data)
+    except ClassificationError as e:
+        return jsonify({"error": str(e)}), e.status
 
-        # Store classification result in DB
-        confidence = max(classification_percentages.values())
-        classification_entry = Classification(
-        image_url=image_url,
-        classification=str(classification_percentages),
-        confidence=confidence
-        )
-
-        session.add(classification_entry)
-        session.commit()
-        
+    if data.get('async'):
+        return queue_job(run_classification, image_url, include_map, map_encoding)
 
-        return jsonify({
-            "classification_percentages": classification_percentages
-        })
+    try:
+        return jsonify(run_classification(image_url, include_map, map_encoding))
+    except ClassificationError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
-        session.rollback()
         print(f"Error during classification: {e}")  # Debug log
         return jsonify({"error": str(e)}), 500
-    finally:
-        session.close()
+
+@classify_bp.route('/classify_batch', methods=['POST'])
+def classify_batch_route():
+    """Classify a list of images (URLs/paths or image ids) in shared inference batches."""
+    data = request.get_json() or {}
+    images = data.get('images')
+    if not isinstance(images, list) or not images:
+        return jsonify({"error": "images must be a non-empty list of image URLs or ids"}), 400
+    if len(images) > MAX_BATCH_IMAGES:
+        return jsonify({"error": f"At most {MAX_BATCH_IMAGES} images per batch"}), 400
+    try:
+        include_map, map_encoding = map_options(data)
+    except ClassificationError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    if data.get('async'):
+        return queue_job(run_batch_classification, images, include_map, map_encoding)
+
+    try:
+        return jsonify({"results": run_batch_classification(images, include_map, map_encoding)})
+    except Exception as e:
+        print(f"Error during batch classification: {e}")  # Debug log
+        return jsonify({"error": str(e)}), 500
+
+@classify_bp.route('/classify_jobs/<job_id>', methods=['GET'])
+def get_classify_job(job_id):
+    """Status of an asynchronous classification job, with its result once finished."""
+    job = classify_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found", "job_id": job_id}), 404
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "result": job["result"],
+        "error": job["error"]
+    })
@@ -1,85 +1,232 @@
-from importlib.abc import Loader
-from flask import Blueprint, request, jsonify
+import json
+import math
+from collections import namedtuple
+from flask import Blueprint, Response, request, jsonify
+from sqlalchemy import and_
 from models import CubeSat
+from propagation import compute_positions, compute_tracks
+from track_store import track_store
+from track_codec import BINARY_MIMETYPE, KIND_ORBITS, KIND_POSITIONS, encode_tracks
 from datetime import datetime, timedelta
-from sgp4.api import Satrec
-from sgp4.ext import jday
 import numpy as np
-from skyfield.api import Loader, EarthSatellite
 from backend.utils import get_db_session, handle_errors
 
 cubesat_bp = Blueprint('cubesat', __name__)
 
-load = Loader('skyfield_data')  # Required for Earth model
+MAX_DURATION_DAYS = 7
+MAX_POINTS_PER_ORBIT = 10080
+MAX_EPOCH_AGE_DAYS = 36500
 
-def compute_orbit(tle1, tle2, duration_days=1, interval_minutes=10):
+ORBIT_CHUNK_SIZE = 64  # Satellites propagated per batch when streaming
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Orbital regimes by mean motion (rev/day) and eccentricity, on the parsed TLE columns
+HEO_ECCENTRICITY = 0.25
+ORBIT_REGIMES = {
+    'leo': and_(CubeSat.mean_motion >= 11.25, CubeSat.eccentricity < HEO_ECCENTRICITY),
+    'meo': and_(CubeSat.mean_motion >= 1.1, CubeSat.mean_motion < 11.25, CubeSat.eccentricity < HEO_ECCENTRICITY),
+    'geo': and_(CubeSat.mean_motion >= 0.9, CubeSat.mean_motion < 1.1, CubeSat.eccentricity < HEO_ECCENTRICITY),
+    'heo': CubeSat.eccentricity >= HEO_ECCENTRICITY
+}
+
+# Plain copy of the TLE columns so tracks can be produced after the DB session closes
+TleRow = namedtuple('TleRow', 'id satellite line1 line2')
+
+def in_bbox(lat, lon, bbox):
+    """Mask of points inside ``bbox`` (min_lon, min_lat, max_lon, max_lat); handles antimeridian boxes."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    inside_lat = (lat >= min_lat) & (lat <= max_lat)
+    if min_lon <= max_lon:
+        return inside_lat & (lon >= min_lon) & (lon <= max_lon)
+    return inside_lat & ((lon >= min_lon) | (lon <= max_lon))
+
+def orbit_points(tracks, k, bbox=None):
+    """Point dicts for track ``k`` of ``tracks``, skipping failed propagations."""
+    keep = tracks.ok[k]
+    if bbox is not None:
+        keep = keep & in_bbox(tracks.lat[k], tracks.lon[k], bbox)
+    return [
+        {
+            'timestamp': (tracks.start + timedelta(minutes=float(tracks.offsets[j]))).isoformat(),
+            'lat': float(tracks.lat[k, j]),
+            'lon': float(tracks.lon[k, j]),
+            'alt': float(tracks.alt[k, j])
+        }
+        for j in np.flatnonzero(keep)
+    ]
+
+def orbit_window_args():
+    """Read and validate the ``duration_days``/``interval_minutes`` query parameters."""
+    duration_days = request.args.get('duration_days', 1, type=float)
+    interval_minutes = request.args.get('interval_minutes', 10, type=float)
+    if not (math.isfinite(duration_days) and math.isfinite(interval_minutes)):
+        raise ValueError("duration_days and interval_minutes must be finite numbers")
+    if not 0 < duration_days <= MAX_DURATION_DAYS:
+        raise ValueError(f"duration_days must be in (0, {MAX_DURATION_DAYS}]")
+    if interval_minutes <= 0 or duration_days * 24 * 60 / interval_minutes > MAX_POINTS_PER_ORBIT:
+        raise ValueError(f"interval_minutes must be positive and yield at most {MAX_POINTS_PER_ORBIT} points")
+    return duration_days, interval_minutes
+
+def orbit_filter_args():
+    """Read the ``satellite`` and ``bbox`` query parameters."""
+    names = [name.strip() for value in request.args.getlist('satellite') for name in value.split(',') if name.strip()]
+    bbox = request.args.get('bbox')
+    if bbox:
+        try:
+            bbox = tuple(float(v) for v in bbox.split(','))
+        except ValueError:
+            bbox = ()
+        if len(bbox) != 4 or not -90 <= bbox[1] <= bbox[3] <= 90:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    return names or None, bbox or None
+
+def float_arg(name, low, high, include_low=True):
+    """Optional finite float query parameter within [low, high] (or (low, high] without ``include_low``)."""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
     try:
-        satellite = Satrec.twoline2rv(tle1, tle2)
-        now = datetime.utcnow()
-        orbit_data = []
+        value = float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value) or value > high or value < low or (value == low and not include_low):
+        raise ValueError(f"{name} must be in {'[' if include_low else '('}{low:g}, {high:g}]")
+    return value
+
+def catalog_filter_args():
+    """SQL filters from the ``regime``, ``max_epoch_age_days`` and ``min_/max_inclination`` query parameters."""
+    filters = []
+    regime = request.args.get('regime')
+    if regime:
+        if regime.lower() not in ORBIT_REGIMES:
+            raise ValueError(f"regime must be one of {', '.join(ORBIT_REGIMES)}")
+        filters.append(ORBIT_REGIMES[regime.lower()])
+    max_epoch_age = float_arg('max_epoch_age_days', 0, MAX_EPOCH_AGE_DAYS, include_low=False)
+    if max_epoch_age is not None:
+        filters.append(CubeSat.epoch >= datetime.utcnow() - timedelta(days=max_epoch_age))
+    min_inclination = float_arg('min_inclination', 0, 180)
+    if min_inclination is not None:
+        filters.append(CubeSat.inclination >= min_inclination)
+    max_inclination = float_arg('max_inclination', 0, 180)
+    if max_inclination is not None:
+        filters.append(CubeSat.inclination <= max_inclination)
+    return filters
 
-        ts = load.timescale()
-        earth = load('de421.bsp')['earth']
+def query_tle_rows(session, names=None, filters=()):
+    """TleRows matching the satellite names and catalog filters, in id order."""
+    query = session.query(CubeSat.id, CubeSat.satellite, CubeSat.line1, CubeSat.line2)
+    if names:
+        query = query.filter(CubeSat.satellite.in_(names))
+    return [TleRow(*r) for r in query.filter(*filters).order_by(CubeSat.id).all()]
 
-        for minute in range(0, duration_days * 24 * 60, interval_minutes):
-            time = now + timedelta(minutes=minute)
-            jd_full = jday(time.year, time.month, time.day, time.hour, time.minute, time.second)
-            jd, fr = np.divmod(jd_full, 1)
+def orbit_start():
+    """Start of a request's tracks: now, rounded up to the whole minute the track store is gridded on."""
+    now = datetime.utcnow()
+    start = now.replace(second=0, microsecond=0)
+    return start + timedelta(minutes=1) if start < now else start
 
-            e, r, v = satellite.sgp4(jd, fr)
+def iter_track_chunks(rows, start, duration_days, interval_minutes, chunk_size=ORBIT_CHUNK_SIZE):
+    """Yield ``(chunk, tracks)`` pairs, propagating ``chunk_size`` satellites at a time from ``start``."""
+    for offset in range(0, len(rows), chunk_size):
+        chunk = rows[offset:offset + chunk_size]
+        tracks = track_store.window(chunk, start=start, duration_days=duration_days,
+                                    interval_minutes=interval_minutes)
+        if tracks is None or tracks.start != start:
+            tracks = compute_tracks(chunk, start=start, duration_days=duration_days,
+                                    interval_minutes=interval_minutes)
+        yield chunk, tracks
 
-            if e == 0:  # Only process valid data
-                satellite_skyfield = EarthSatellite(tle1, tle2, 'Cubesat', ts)
-                geocentric = satellite_skyfield.at(ts.utc(time.year, time.month, time.day, 
-                                                           time.hour, time.minute, time.second))
-                subpoint = geocentric.subpoint()
+def iter_orbits(rows, start, duration_days, interval_minutes, bbox=None):
+    """Yield ``{'satellite', 'orbit'}`` dicts as each chunk of satellites is propagated."""
+    for chunk, tracks in iter_track_chunks(rows, start, duration_days, interval_minutes):
+        orbit_by_row = {int(i): k for k, i in enumerate(tracks.index)}
+        for i, row in enumerate(chunk):
+            k = orbit_by_row.get(i)
+            orbit = orbit_points(tracks, k, bbox) if k is not None else []
+            if bbox is not None and not orbit:
+                continue
+            yield {'satellite': row.satellite, 'orbit': orbit}
 
-                orbit_data.append({
-                    'timestamp': time.isoformat(),
-                    'lat': subpoint.latitude.degrees,
-                    'lon': subpoint.longitude.degrees,
-                    'alt': subpoint.elevation.km  # Corrected altitude in km
-                })
-            else:
-                print(f" SGP4 Error: {e} at {time}")  # Debugging: Print error code
+def binary_orbits(rows, start, duration_days, interval_minutes, bbox=None):
+    """Encode every track into the compact binary layout (NaN where there is no point)."""
+    n_times = len(np.arange(0, duration_days * 24 * 60, interval_minutes))
+    points = np.full((3, len(rows), n_times), np.nan, dtype=np.float32)
+    for offset, (chunk, tracks) in zip(range(0, len(rows), ORBIT_CHUNK_SIZE),
+                                       iter_track_chunks(rows, start, duration_days, interval_minutes)):
+        keep = tracks.ok if bbox is None else tracks.ok & in_bbox(tracks.lat, tracks.lon, bbox)
+        target = offset + tracks.index
+        for axis, values in enumerate((tracks.lat, tracks.lon, tracks.alt)):
+            points[axis, target] = np.where(keep, values, np.nan)
+    return encode_tracks(KIND_ORBITS, [row.satellite for row in rows], start, interval_minutes, *points)
 
-        return orbit_data
+def wants_binary():
+    return request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
 
-    except Exception as e:
-        print(" Error in compute_orbit:", str(e))
-        return []  # Return empty list on failure
+def stream_ndjson(orbits):
+    for orbit in orbits:
+        yield json.dumps(orbit) + '\n'
+
+def stream_json_array(orbits):
+    yield '['
+    for n, orbit in enumerate(orbits):
+        yield (',' if n else '') + json.dumps(orbit)
+    yield ']'
 
 @cubesat_bp.route('/cubesat_orbits', methods=['GET'])
 @handle_errors
 def get_cubesat_orbits():
+    """Orbit tracks as a JSON array, or streamed per satellite with ``stream=ndjson|json``."""
+    try:
+        duration_days, interval_minutes = orbit_window_args()
+        names, bbox = orbit_filter_args()
+        filters = catalog_filter_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     with get_db_session() as session:
-        results = session.query(CubeSat).all()
-        orbits = []
-        for row in results:
-            orbit = compute_orbit(row.line1, row.line2)
-            orbits.append({
-                'satellite': row.satellite,
-                'orbit': orbit
-            })
+        rows = query_tle_rows(session, names, filters)
+
+    # One start for every chunk, whether served from the track store or propagated live
+    start = orbit_start()
+    if wants_binary():
+        return Response(binary_orbits(rows, start, duration_days, interval_minutes, bbox),
+                        mimetype=BINARY_MIMETYPE)
 
-        print("Orbits data:", orbits)  # Debugging: Print the orbits data
-        return jsonify(orbits)
+    orbits = iter_orbits(rows, start, duration_days, interval_minutes, bbox)
+
+    stream = request.args.get('stream')
+    if stream is None and NDJSON_MIMETYPE in request.headers.get('Accept', ''):
+        stream = 'ndjson'
+    if stream == 'ndjson':
+        return Response(stream_ndjson(orbits), mimetype=NDJSON_MIMETYPE)
+    if stream == 'json':
+        return Response(stream_json_array(orbits), mimetype='application/json')
+    return jsonify(list(orbits))
 
 @cubesat_bp.route('/cubesat_positions', methods=['GET'])
 @handle_errors
 def get_cubesat_positions():
     """Fetch CubeSat positions from the database and return as JSON."""
+    try:
+        filters = catalog_filter_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     with get_db_session() as session:
-        results = session.query(CubeSat).all()
-        data = []
-        for row in results:
-            d = row.to_dict()
-            # Convert numpy float64 to native float, handle None safely
-            d['lat'] = float(d['lat']) if d['lat'] is not None else None
-            d['lon'] = float(d['lon']) if d['lon'] is not None else None
-            d['alt'] = float(d['alt']) if d['alt'] is not None else None
-            data.append(d)
-        return jsonify(data)
+        results = query_tle_rows(session, filters=filters)
+
+    positions = compute_positions(results)
+    if wants_binary():
+        points = np.array([[np.nan if v is None else v for v in position] for position in positions],
+                          dtype=np.float32).reshape(len(results), 3)
+        payload = encode_tracks(KIND_POSITIONS, [row.satellite for row in results], datetime.utcnow(), 0,
+                                points[:, [0]], points[:, [1]], points[:, [2]])
+        return Response(payload, mimetype=BINARY_MIMETYPE)
+    data = [
+        {"satellite": row.satellite, "lat": lat, "lon": lon, "alt": alt}
+        for row, (lat, lon, alt) in zip(results, positions)
+    ]
+    return jsonify(data)
 
 @cubesat_bp.route('/cubesat_chart_data', methods=['GET'])
 @handle_errors
@@ -89,17 +236,11 @@ def get_cubesat_chart_data():
         results = session.query(CubeSat).all()
         labels, data = [], []
 
-        for row in results:
-            position = row.compute_position()
-            if position is None or len(position) != 3:
-                print(f"Invalid position data for satellite {row.satellite}: {position}")
-                continue
-            lat, lon, alt = position
+        for row, (lat, lon, alt) in zip(results, compute_positions(results)):
             if alt is not None:
                 labels.append(row.satellite)
-                data.append(float(alt))  # Convert numpy float64 to float
+                data.append(alt)
 
-        print(f"Labels: {labels}, Data: {data}")  # Debugging statement
         return jsonify({'labels': labels, 'data': data})
 
 @cubesat_bp.route('/cubesat_heatmap_data', methods=['GET'])
@@ -110,13 +251,8 @@ def get_cubesat_heatmap_data():
         results = session.query(CubeSat).all()
         heatmap_data = {'max': 100, 'data': []}
 
-        for row in results:
-            position = row.compute_position()
-            if position is None or len(position) != 3:
-                print(f"Invalid position data for satellite {row.satellite}: {position}")
-                continue
-            lat, lon, _ = position
+        for lat, lon, _ in compute_positions(results):
             if lat is not None and lon is not None:
-                heatmap_data['data'].append({"x": float(lon), "y": float(lat), "value": 1})  # Convert numpy float64 to float
+                heatmap_data['data'].append({"x": lon, "y": lat, "value": 1})
 
         return jsonify(heatmap_data)
@@ -1,115 +1,492 @@
+import hashlib
+import random
+import re
+import threading
 import requests
-from flask import Blueprint, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Blueprint, jsonify, url_for
+from sqlalchemy import or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 from database import engine
-from models import CubeSat
+from models import CubeSat, TleSourceState
+from propagation import norad_number, satrec_cache, tle_elements, tle_epoch
+from track_store import track_store
 import datetime
 import logging
 import os
+import time
 
 tle_update_bp = Blueprint('tle_update', __name__)
 Session = sessionmaker(bind=engine)
 
-CELESTRAK_URL = "https://celestrak.com/NORAD/elements/cubesat.txt"
-UPDATE_INTERVAL_HOURS = 24  # Configurable time limit for automatic updates
-LAST_UPDATE_FILE = os.path.join(os.path.dirname(__file__), 'tle_last_update.txt')
+# Point at a local stand-in (e.g. ``python -m http.server``) for testing
+CELESTRAK_URL = os.getenv('CELESTRAK_URL', "https://celestrak.com/NORAD/elements/cubesat.txt")
+# TLE sources: URLs and/or local file paths, separated by commas or whitespace
+TLE_SOURCES = [source for source in re.split(r'[,\s]+', os.getenv('TLE_SOURCES', CELESTRAK_URL)) if source]
+UPDATE_INTERVAL_HOURS = float(os.getenv('UPDATE_INTERVAL_HOURS', 24))  # Time limit between fetches
+# Random delay added to each scheduled refresh so workers and hosts spread out
+UPDATE_JITTER_MINUTES = float(os.getenv('UPDATE_JITTER_MINUTES', 30))
+# A source whose fetch or update failed is due again after this delay, not a full interval
+RETRY_MINUTES = float(os.getenv('TLE_RETRY_MINUTES', 10))
+FETCH_TIMEOUT = 60  # Seconds
+FETCH_WORKERS = int(os.getenv('TLE_FETCH_WORKERS', 8))  # Sources fetched concurrently
+CHUNK_SIZE = 64 * 1024
 
-def fetch_latest_tle():
+TLE_LINE = re.compile(r'^[12] [0-9A-Z ]{5}')
+
+def make_http_session(pool_size=FETCH_WORKERS):
+    """``requests.Session`` whose connection pool fits every concurrent fetch."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+http_session = make_http_session()
+
+def is_remote(source):
+    return source.startswith(('http://', 'https://'))
+
+def record_norad_id(line1):
+    """Catalog number of a TLE as an int (the key apply_tle_updates uses), or None if unreadable."""
+    try:
+        return norad_number(line1[2:7])
+    except ValueError:
+        return None
+
+def tle_record(satellite, line1, line2):
+    return {
+        "satellite": satellite,  # None for 2-line entries; see dedupe_by_norad
+        "line1": line1,
+        "line2": line2,
+        "norad_id": record_norad_id(line1),
+        "epoch": tle_epoch(line1)
+    }
+
+def parse_tle_lines(lines):
     """
-    Fetch latest TLE data from Celestrak Cubesat catalog.
-    Returns a list of dicts with keys: satellite, line1, line2
+    Stream TLE records from an iterable of lines, 3-line (name, line 1,
+    line 2) or bare 2-line. Records with short or unpaired lines are skipped.
+    Yields dicts with keys: satellite, line1, line2, norad_id, epoch
     """
-    response = requests.get(CELESTRAK_URL)
-    response.raise_for_status()
-    lines = response.text.strip().splitlines()
-    tle_data = []
-    for i in range(0, len(lines), 3):
-        if i + 2 >= len(lines):
-            break
-        satellite = lines[i].strip()
-        line1 = lines[i+1].strip()
-        line2 = lines[i+2].strip()
-        # Basic validation: TLE lines length and format
-        if len(line1) < 69 or len(line2) < 69:
-            logging.warning(f"Skipping satellite {satellite} due to invalid TLE line length")
+    name, line1 = None, None
+    for raw in lines:
+        line = raw.strip()
+        if not line:
             continue
-        tle_data.append({
-            "satellite": satellite,
-            "line1": line1,
-            "line2": line2
-        })
-    return tle_data
+        if TLE_LINE.match(line):
+            # Basic validation: TLE lines length and format
+            if len(line) < 69:
+                logging.warning(f"Skipping satellite {name or line[2:7].strip()} due to invalid TLE line length")
+                name, line1 = None, None
+            elif line[0] == '1':
+                line1 = line
+            elif line1 is not None:
+                yield tle_record(name, line1, line)
+                name, line1 = None, None
+            continue
+        if line1 is not None:
+            logging.warning(f"Skipping satellite {name} due to missing TLE line 2")
+            line1 = None
+        name = line
 
-def should_update(last_update_time):
+def parse_tle_text(text):
     """
-    Determine if enough time has passed since last update to proceed.
+    Parse 3-line TLE text.
+    Returns a list of dicts with keys: satellite, line1, line2, norad_id, epoch
+    """
+    return list(parse_tle_lines(text.splitlines()))
+
+def hashed_lines(chunks, hasher):
+    """Split byte chunks into text lines while feeding every byte to ``hasher``."""
+    pending = b''
+    for chunk in chunks:
+        hasher.update(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+    if pending:
+        yield pending.decode('utf-8', 'replace')
+
+def fetch_source(source, etag=None, last_modified=None, content_hash=None):
+    """Fetch and parse one source, conditionally.
+
+    Returns a summary with ``status`` 'not_modified' (HTTP 304), 'unchanged'
+    (same SHA-256 as ``content_hash``), 'fetched' (with ``records``) or
+    'error'.
+    """
+    start = time.perf_counter()
+    result = {"source": source, "etag": etag, "last_modified": last_modified}
+    try:
+        hasher = hashlib.sha256()
+        if is_remote(source):
+            headers = {}
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            with http_session.get(source, headers=headers, timeout=FETCH_TIMEOUT, stream=True) as response:
+                if response.status_code == 304:
+                    result["status"] = "not_modified"
+                    return result
+                response.raise_for_status()
+                result["etag"] = response.headers.get('ETag')
+                result["last_modified"] = response.headers.get('Last-Modified')
+                records = list(parse_tle_lines(hashed_lines(response.iter_content(CHUNK_SIZE), hasher)))
+        else:
+            with open(source, 'rb') as f:
+                records = list(parse_tle_lines(hashed_lines(iter(lambda: f.read(CHUNK_SIZE), b''), hasher)))
+
+        result["content_hash"] = hasher.hexdigest()
+        if result["content_hash"] == content_hash:
+            result["status"] = "unchanged"
+        else:
+            result.update(status="fetched", records=records)
+        return result
+    except Exception as e:
+        logging.error(f"Error fetching TLE source {source}: {e}")
+        result.update(status="error", error=str(e))
+        return result
+    finally:
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+def fetch_sources(sources, validators=None):
+    """Fetch ``sources`` concurrently; ``validators`` maps source to (etag, last_modified, content_hash)."""
+    validators = validators or {}
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(sources)))) as pool:
+        return list(pool.map(lambda source: fetch_source(source, *validators.get(source, ())), sources))
+
+def dedupe_by_norad(records):
+    """One record per NORAD catalog number, keeping the newest epoch (later sources win ties).
+
+    Unnamed (2-line) records take their name from another source listing the
+    same object; any still unnamed keep ``satellite`` None (see apply_tle_updates).
+    Records without a readable catalog number are passed through for
+    apply_tle_updates to skip.
     """
-    if last_update_time is None:
-        return True
+    newest = {}
+    unreadable = []
+    for record in records:
+        if record["norad_id"] is None:
+            unreadable.append(record)
+            continue
+        current = newest.get(record["norad_id"])
+        if current is None or (record["epoch"] or datetime.datetime.min) >= (current["epoch"] or datetime.datetime.min):
+            if current is not None and record["satellite"] is None:
+                record = dict(record, satellite=current["satellite"])
+            newest[record["norad_id"]] = record
+        elif current["satellite"] is None:
+            newest[record["norad_id"]] = dict(current, satellite=record["satellite"])
+    return list(newest.values()) + unreadable
+
+def get_source_state(session, url):
+    state = session.query(TleSourceState).filter(TleSourceState.url == url).first()
+    if state is None:
+        state = TleSourceState(url=url)
+        session.add(state)
+    return state
+
+def claim_source(session, url, force=False):
+    """Atomically mark ``url`` as checked now if it is due (or ``force``).
+
+    The conditional UPDATE acts as a lease across processes: when several
+    workers race, only the one whose UPDATE matched goes on to fetch.
+    """
+    try:
+        get_source_state(session, url)
+        session.commit()
+    except IntegrityError:
+        session.rollback()  # Another worker created the row first
+
     now = datetime.datetime.utcnow()
-    elapsed = now - last_update_time
-    return elapsed.total_seconds() >= UPDATE_INTERVAL_HOURS * 3600
+    stmt = update(TleSourceState).where(TleSourceState.url == url)
+    if not force:
+        cutoff = now - datetime.timedelta(hours=UPDATE_INTERVAL_HOURS)
+        stmt = stmt.where(or_(TleSourceState.last_checked.is_(None), TleSourceState.last_checked <= cutoff))
+    claimed = session.execute(stmt.values(last_checked=now)).rowcount == 1
+    session.commit()
+    return claimed
 
-@tle_update_bp.route('/update_tle', methods=['POST'])
-def update_tle_data():
+def release_source(state):
+    """Back off a claimed source after a failure: due again in RETRY_MINUTES."""
+    state.last_checked = state.last_checked - datetime.timedelta(hours=UPDATE_INTERVAL_HOURS) \
+        + datetime.timedelta(minutes=RETRY_MINUTES)
+
+def next_due(session, sources):
+    """None if any of ``sources`` is due for a refresh now, else when the first one will be."""
+    checked = dict(session.query(TleSourceState.url, TleSourceState.last_checked)
+                   .filter(TleSourceState.url.in_(sources)))
+    if any(checked.get(source) is None for source in sources):
+        return None
+    due = min(checked.values()) + datetime.timedelta(hours=UPDATE_INTERVAL_HOURS)
+    return None if due <= datetime.datetime.utcnow() else due
+
+def upsert_statement():
+    """``INSERT ... ON CONFLICT (norad_id) DO UPDATE`` for the engine's dialect."""
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(CubeSat)
+    columns = ("satellite", "line1", "line2", "epoch", "inclination", "eccentricity", "mean_motion")
+    return stmt.on_conflict_do_update(
+        index_elements=[CubeSat.norad_id],
+        set_={column: stmt.excluded[column] for column in columns}
+    )
+
+def apply_tle_updates(session, tle_data):
+    """Diff parsed TLEs against the catalog and write only the changes, in one bulk upsert.
+
+    Rows are keyed on the NORAD id, so distinct objects sharing a name are
+    stored separately (and counted in ``shared_names``). Unnamed records keep
+    the stored name, or are named after their catalog number. Element sets
+    older than the stored epoch are left alone (``stale``). The parsed
+    element columns are written with the lines. Returns ``(counts,
+    changed_ids)`` where counts holds added/updated/unchanged/stale/skipped/
+    shared_names and changed_ids the ids of updated rows.
     """
-    Fetch latest TLE data and update the CubeSat database.
-    Adds new satellites and updates existing ones.
-    Respects update interval to avoid excessive requests.
-    Skips satellites with invalid TLE data.
+    existing = {row.norad_id: row for row in session.execute(
+        select(CubeSat.id, CubeSat.norad_id, CubeSat.satellite, CubeSat.line1, CubeSat.line2, CubeSat.epoch)
+        .where(CubeSat.norad_id.isnot(None)))}
+
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "stale": 0, "skipped": 0, "shared_names": 0}
+    feed = {}
+    for tle in tle_data:
+        if not tle["line1"] or not tle["line2"]:
+            logging.warning(f"Skipping satellite {tle['satellite']} due to missing TLE lines")
+            counts["skipped"] += 1
+            continue
+        elements = tle_elements(tle["line1"], tle["line2"])
+        if elements["norad_id"] is None:
+            logging.warning(f"Skipping satellite {tle['satellite']} due to an unreadable NORAD id")
+            counts["skipped"] += 1
+            continue
+        feed[elements["norad_id"]] = (tle, elements)  # An object listed twice keeps its last entry
+
+    objects_by_name = {}
+    for norad_id, (tle, _) in feed.items():
+        if tle["satellite"]:
+            objects_by_name.setdefault(tle["satellite"], []).append(norad_id)
+    shared = {name: ids for name, ids in objects_by_name.items() if len(ids) > 1}
+    if shared:
+        counts["shared_names"] = sum(len(ids) for ids in shared.values())
+        logging.info(f"{counts['shared_names']} objects share {len(shared)} names (e.g. "
+                     f"{next(iter(shared))!r}); each is stored under its NORAD id")
+
+    changes = []
+    changed_ids = []
+    for norad_id, (tle, elements) in feed.items():
+        current = existing.get(norad_id)
+        name = tle["satellite"] or (current.satellite if current is not None else str(norad_id))
+        epoch = elements["epoch"]
+        if current is None:
+            counts["added"] += 1
+        elif (current.satellite, current.line1, current.line2) == (name, tle["line1"], tle["line2"]):
+            counts["unchanged"] += 1
+            continue
+        elif epoch and epoch < (current.epoch or tle_epoch(current.line1) or epoch):
+            counts["stale"] += 1
+            continue
+        else:
+            counts["updated"] += 1
+            changed_ids.append(current.id)
+        changes.append({"satellite": name, "line1": tle["line1"], "line2": tle["line2"], **elements})
+
+    if changes:
+        session.execute(upsert_statement(), changes)
+    return counts, changed_ids
+
+def refresh_tle_catalog(session, sources=None, force=False):
+    """Conditionally fetch every due source and apply any changes; returns a summary dict.
+
+    Sources are fetched concurrently and merged, keeping the newest epoch
+    per NORAD id. Skips sources inside the update interval unless
+    ``force``, and leaves the catalog (and derived caches) untouched when
+    every source answers 304, serves byte-identical content or fails.
+    Failed sources are listed under ``failed`` and retried after
+    RETRY_MINUTES.
     """
-    session = Session()
+    sources = sources or TLE_SOURCES
+    claimed = [source for source in sources if claim_source(session, source, force)]
+    if not claimed:
+        return {"message": "Update skipped due to time limit"}
+    states = {source: get_source_state(session, source) for source in claimed}
+
+    start = time.perf_counter()
+    results = fetch_sources(claimed, {source: (state.etag, state.last_modified, state.content_hash)
+                                      for source, state in states.items()})
+    fetched = time.perf_counter()
+    elapsed_ms = {"fetch": round((fetched - start) * 1000, 1)}
+
+    records = []
+    failed = []
+    for result in results:
+        state = states[result["source"]]
+        if result["status"] in ("unchanged", "fetched"):
+            state.etag, state.last_modified = result["etag"], result["last_modified"]
+        if result["status"] == "fetched":
+            records.extend(result["records"])
+        elif result["status"] == "error":
+            release_source(state)
+            failed.append(result["source"])
+    summaries = [{key: value for key, value in result.items() if key != "records"} for result in results]
+    for summary, result in zip(summaries, results):
+        summary["records"] = len(result.get("records", ()))
+
+    if not records:
+        session.commit()
+        not_modified = all(result["status"] == "not_modified" for result in results)
+        message = "TLE fetch failed" if len(failed) == len(results) else \
+            "TLE data not modified" if not_modified else "TLE data unchanged"
+        return {"message": message, "failed": failed, "elapsed_ms": elapsed_ms, "sources": summaries}
+
     try:
-        # Check last update time stored in a simple file or DB (for demo, use a file)
-        try:
-            with open(LAST_UPDATE_FILE, 'r') as f:
-                last_update_str = f.read().strip()
-                last_update_time = datetime.datetime.fromisoformat(last_update_str)
-        except Exception:
-            last_update_time = None
-
-        if not should_update(last_update_time):
-            return jsonify({"message": "Update skipped due to time limit"}), 200
-
-        tle_data = fetch_latest_tle()
-        updated = 0
-        added = 0
-        skipped = 0
-        for tle in tle_data:
-            sat_name = tle["satellite"]
-            if not tle["line1"] or not tle["line2"]:
-                logging.warning(f"Skipping satellite {sat_name} due to missing TLE lines")
-                skipped += 1
-                continue
-            existing = session.query(CubeSat).filter(CubeSat.satellite == sat_name).first()
-            if existing:
-                if existing.line1 != tle["line1"] or existing.line2 != tle["line2"]:
-                    existing.line1 = tle["line1"]
-                    existing.line2 = tle["line2"]
-                    updated += 1
-            else:
-                new_sat = CubeSat(
-                    satellite=sat_name,
-                    line1=tle["line1"],
-                    line2=tle["line2"]
-                )
-                session.add(new_sat)
-                added += 1
+        counts, changed_ids = apply_tle_updates(session, dedupe_by_norad(records))
+    except Exception:
+        session.rollback()
+        for state in states.values():
+            release_source(state)
         session.commit()
+        raise
+    for result in results:
+        if result["status"] == "fetched":
+            state = states[result["source"]]
+            state.content_hash = result["content_hash"]
+            state.last_updated = state.last_checked
+    session.commit()
+    elapsed_ms["write"] = round((time.perf_counter() - fetched) * 1000, 1)
+    logging.info(f"TLE update from {len(claimed)} sources: {counts} in {elapsed_ms} ms")
+
+    # Drop parsed TLEs that are now stale
+    satrec_cache.invalidate(changed_ids)
+    if counts["updated"] or counts["added"]:
+        track_store.refresh_in_background()
+    return dict(counts, message="TLE data updated", failed=failed, elapsed_ms=elapsed_ms, sources=summaries)
+
+class TleRefreshScheduler:
+    """Refreshes the TLE catalog every UPDATE_INTERVAL_HOURS (plus jitter) on a daemon thread.
+
+    Every worker may run one; claim_source() makes sure only one of them
+    fetches per interval. After a failed refresh the next run comes
+    RETRY_MINUTES later. ``status()`` reports this process's last run.
+    """
+
+    def __init__(self, sources=None, interval_hours=UPDATE_INTERVAL_HOURS,
+                 jitter_minutes=UPDATE_JITTER_MINUTES):
+        self.sources = sources or TLE_SOURCES
+        self.interval_hours = interval_hours
+        self.jitter_minutes = jitter_minutes
+        self._run_lock = threading.Lock()
+        self._status_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._status = {"running": False, "last_started": None, "last_finished": None,
+                        "duration_ms": None, "result": None, "error": None, "next_run": None}
+
+    def _set_status(self, **fields):
+        with self._status_lock:
+            self._status.update(fields)
+
+    def run_once(self, force=False):
+        """Refresh now unless a refresh is already running in this process.
+
+        Returns the refresh summary, or None if skipped or failed.
+        """
+        if not self._run_lock.acquire(blocking=False):
+            logging.info("TLE refresh already running; skipping")
+            return None
+        session = Session()
+        start = time.perf_counter()
+        self._set_status(running=True, last_started=datetime.datetime.utcnow().isoformat(), error=None)
+        try:
+            result = refresh_tle_catalog(session, self.sources, force=force)
+            self._set_status(result=result)
+            return result
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error updating TLE data: {e}")
+            self._set_status(error=str(e))
+            return None
+        finally:
+            session.close()
+            self._set_status(running=False, last_finished=datetime.datetime.utcnow().isoformat(),
+                             duration_ms=round((time.perf_counter() - start) * 1000, 1))
+            self._run_lock.release()
+
+    def start(self):
+        """Refresh now and then every interval on a daemon thread."""
+        def run():
+            while True:
+                result = self.run_once()
+                if (result is None and self.status()["error"]) or (result and result.get("failed")):
+                    delay = RETRY_MINUTES * 60 + random.uniform(0, 60)
+                else:
+                    delay = self.interval_hours * 3600 + random.uniform(0, self.jitter_minutes * 60)
+                next_run = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+                self._set_status(next_run=next_run.isoformat())
+                self._wake.wait(delay)
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=run, name='tle-refresh-scheduler', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def trigger(self):
+        """Run a refresh soon without blocking the caller."""
+        if self._thread is not None and self._thread.is_alive():
+            self._wake.set()
+        else:
+            threading.Thread(target=self.run_once, name='tle-refresh', daemon=True).start()
+
+    def status(self):
+        with self._status_lock:
+            return dict(self._status, interval_hours=self.interval_hours, jitter_minutes=self.jitter_minutes)
 
-        # Update last update time
-        with open(LAST_UPDATE_FILE, 'w') as f:
-            f.write(datetime.datetime.utcnow().isoformat())
 
+tle_scheduler = TleRefreshScheduler()
+
+@tle_update_bp.route('/update_tle', methods=['POST'])
+def update_tle_data():
+    """
+    Queue a refresh of the CubeSat TLE catalog on the background scheduler.
+    Respects update interval to avoid excessive requests: when no source is
+    due, nothing is queued and the response says when one will be.
+    """
+    session = Session()
+    try:
+        due = next_due(session, tle_scheduler.sources)
+    finally:
+        session.close()
+    status_url = url_for('tle_update.tle_status')
+    if due is not None:
         return jsonify({
-            "message": "TLE data updated",
-            "updated": updated,
-            "added": added,
-            "skipped": skipped
+            "message": f"TLE refresh not scheduled: sources were checked within the last {UPDATE_INTERVAL_HOURS:g} hours",
+            "next_due": due.isoformat(),
+            "status_url": status_url
         })
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Error updating TLE data: {e}")
-        return jsonify({"error": str(e)}), 500
+
+    tle_scheduler.trigger()
+    return jsonify({
+        "message": "TLE refresh scheduled",
+        "status_url": status_url
+    }), 202
+
+@tle_update_bp.route('/tle_status', methods=['GET'])
+def tle_status():
+    """Read-only view of the refresh scheduler and the stored per-source fetch state."""
+    session = Session()
+    try:
+        sources = [{
+            "url": state.url,
+            "etag": state.etag,
+            "last_modified": state.last_modified,
+            "content_hash": state.content_hash,
+            "last_checked": state.last_checked.isoformat() if state.last_checked else None,
+            "last_updated": state.last_updated.isoformat() if state.last_updated else None
+        } for state in session.query(TleSourceState).order_by(TleSourceState.id)]
+        return jsonify({"scheduler": tle_scheduler.status(), "sources": sources})
     finally:
         session.close()
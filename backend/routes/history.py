@@ -65,6 +65,15 @@ def delete_image(image_id):
                     except Exception as file_err:
                         print(f"Failed to delete image file: {file_err}")
 
+                # Index products computed locally at capture time
+                for index_url in (image.ndvi_image_url, image.evi_image_url, image.savi_image_url, image.gci_image_url):
+                    index_path = os.path.join('static', index_url) if index_url and not index_url.startswith('http') else None
+                    if index_path and os.path.exists(index_path):
+                        try:
+                            os.remove(index_path)
+                        except Exception as file_err:
+                            print(f"Failed to delete index file: {file_err}")
+
                 db.delete(image)
                 db.commit()
                 return jsonify({"message": "Image deleted successfully"})
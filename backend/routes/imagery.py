@@ -1,17 +1,22 @@
 import base64
+import importlib
 import os
+import threading
+import time
 import uuid
 import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, send_file, url_for
 from flask_cors import cross_origin
 from PIL import Image
-import ee
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 from database import engine
 from models import ImageHistory
+from capture_cache import capture_cache, snap_to_cell
+from spectral import INDEX_VIS, load_npy_bands, render_products
 
 load_dotenv()
 
@@ -30,18 +35,184 @@ ALLOWED_DATASETS = [
     "USDA/NAIP/DOQQ"
 ]
 
-# Initialize Earth Engine
-try:
-    service_account = os.getenv('EE_SERVICE_ACCOUNT')
-    credentials = ee.ServiceAccountCredentials(service_account, 'credentials.json')
-    ee.Initialize(credentials)
-    logger.info("Earth Engine initialized successfully.")
-except Exception as e:
-    logger.error(f"Failed to initialize Earth Engine: {str(e)}")
-    raise
+# RGB bands per dataset
+BAND_MAPPING = {
+    "COPERNICUS/S2_SR_HARMONIZED": ['B4', 'B3', 'B2'],
+    "LANDSAT/LC08/C02/T1_L2": ['SR_B4', 'SR_B3', 'SR_B2'],
+    "LANDSAT/LC09/C02/T1_L2": ['SR_B4', 'SR_B3', 'SR_B2'],
+    "MODIS/006/MOD09GA": ['sur_refl_b01', 'sur_refl_b04', 'sur_refl_b03'],
+    "USDA/NAIP/DOQQ": ['R', 'G', 'B']
+}
+
+# Visualization ranges per dataset
+VIS_RANGES = {
+    "COPERNICUS/S2_SR_HARMONIZED": {"min": 0, "max": 3000},
+    "LANDSAT/LC08/C02/T1_L2": {"min": 0, "max": 10000},
+    "LANDSAT/LC09/C02/T1_L2": {"min": 0, "max": 10000},
+    "MODIS/006/MOD09GA": {"min": 0, "max": 5000},
+    "USDA/NAIP/DOQQ": {"min": 0, "max": 255}
+}
+
+# Datasets with a Scene Classification Layer for cloud masking; known up front
+# so capture does not need a bandNames() round trip
+SCL_DATASETS = {"COPERNICUS/S2_SR_HARMONIZED"}
+
+# Captures search this fixed window, so a location/dataset query is deterministic and cacheable
+CAPTURE_START_DATE = '2023-01-01'
+CAPTURE_END_DATE = '2024-12-31'
+CAPTURE_IMAGES = ('rgb', 'ndvi', 'evi', 'savi', 'gci')
+
+# Download the RGB bands once as NPY and compute the index products locally
+# (see spectral.py), instead of rendering a thumbnail per product
+LOCAL_INDICES = os.getenv('CAPTURE_LOCAL_INDICES', '').lower() in ('1', 'true', 'yes')
+LOCAL_PRODUCTS = ('rgb', 'ndvi', 'evi', 'savi', 'gci')
+
+THUMB_PARAMS = {'format': 'png', 'dimensions': 512}
+# Thumbnail URLs are independent Earth Engine round trips, generated concurrently
+THUMB_WORKERS = int(os.getenv('EE_THUMB_WORKERS', 6))
+DOWNLOAD_TIMEOUT = 60  # Seconds
+
+# Module providing the Earth Engine API; point EE_MODULE at a local fake for tests
+EE_MODULE = os.getenv('EE_MODULE', 'ee')
+ee = None
+_ee_lock = threading.Lock()
+thumb_executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix='ee-thumb')
+
+def get_ee():
+    """The Earth Engine module, imported and initialized on first use."""
+    global ee
+    if ee is None:
+        with _ee_lock:
+            if ee is None:
+                module = importlib.import_module(EE_MODULE)
+                try:
+                    service_account = os.getenv('EE_SERVICE_ACCOUNT')
+                    credentials = module.ServiceAccountCredentials(service_account, 'credentials.json')
+                    module.Initialize(credentials)
+                    logger.info("Earth Engine initialized successfully.")
+                except Exception as e:
+                    logger.error(f"Failed to initialize Earth Engine: {str(e)}")
+                    raise
+                ee = module
+    return ee
 
 Session = sessionmaker(bind=engine)
 
+class StageTimer:
+    """Wall-clock milliseconds per named stage, for logs and the Server-Timing header."""
+
+    def __init__(self):
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def timed(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.timings[name] = (time.perf_counter() - start) * 1000
+
+    def header(self):
+        return ', '.join(f"{name};dur={ms:.1f}" for name, ms in self.timings.items())
+
+def capture_query(ee, latitude, longitude, dataset):
+    """Cloud-masked image to capture, or None if no image matches.
+
+    Only builds the computation graph; nothing is sent to Earth Engine yet.
+    """
+    point = ee.Geometry.Point([longitude, latitude])
+
+    image_collection = ee.ImageCollection(dataset) \
+        .filterBounds(point) \
+        .filterDate(CAPTURE_START_DATE, CAPTURE_END_DATE)
+
+    # Optional cloud filter for certain datasets
+    if dataset.startswith("COPERNICUS") or "LANDSAT" in dataset:
+        image_collection = image_collection.filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 10)) \
+                                           .sort('CLOUDY_PIXEL_PERCENTAGE')
+
+    image = image_collection.first()
+
+    if image is None:
+        return None
+
+    scl = image.select('SCL') if dataset in SCL_DATASETS else None
+
+    # Fix cloud mask logic: mask clouds and shadows (SCL 3, 8, 9, 10)
+    if scl is not None:
+        cloud_mask = scl.eq(3).Or(scl.eq(8)).Or(scl.eq(9)).Or(scl.eq(10))
+        masked_image = image.updateMask(cloud_mask.Not())
+    else:
+        masked_image = image
+    return masked_image
+
+def capture_layers(masked_image, dataset):
+    """Earth Engine visualizations keyed by CAPTURE_IMAGES name."""
+    bands = BAND_MAPPING.get(dataset, ['B4', 'B3', 'B2'])
+    vis_params = dict(VIS_RANGES.get(dataset, {"min": 0, "max": 3000}), bands=bands)
+
+    def vis(name):
+        vmin, vmax, palette = INDEX_VIS[name]
+        return {'min': vmin, 'max': vmax, 'palette': palette}
+
+    # NDVI, EVI, SAVI, GCI calculations adjusted for band names (mirrored by spectral.compute_indices)
+    ndvi = masked_image.normalizedDifference([bands[0], bands[1]]).rename('NDVI').visualize(**vis('ndvi'))
+    evi = masked_image.expression(
+        '2.5 * ((b1 - b2) / (b1 + 6 * b2 - 7.5 * b3 + 1))',
+        {'b1': masked_image.select(bands[0]), 'b2': masked_image.select(bands[1]), 'b3': masked_image.select(bands[2])}
+    ).rename('EVI').visualize(**vis('evi'))
+    savi = masked_image.expression(
+        '(b1 - b2) / (b1 + b2 + 0.5) * (1 + 0.5)',
+        {'b1': masked_image.select(bands[0]), 'b2': masked_image.select(bands[1])}
+    ).rename('SAVI').visualize(**vis('savi'))
+    gci = masked_image.expression(
+        'b2 / b3 - 1',
+        {'b2': masked_image.select(bands[1]), 'b3': masked_image.select(bands[2])}
+    ).rename('GCI').visualize(**vis('gci'))
+
+    return {
+        'rgb': masked_image.visualize(**vis_params),
+        'ndvi': ndvi,
+        'evi': evi,
+        'savi': savi,
+        'gci': gci
+    }
+
+def fetch_thumbnail(layer, name, timer, download):
+    """Generate a thumbnail URL and optionally download it, as one chained task."""
+    url = timer.timed(f"thumb_{name}", layer.getThumbURL, THUMB_PARAMS)
+    if not download:
+        return url, None
+    response = timer.timed(f"download_{name}", requests.get, url, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return url, response.content
+
+def request_thumbnails(layers, timer, download_all=False):
+    """``{name: (url, png bytes or None)}`` with every round trip issued concurrently.
+
+    The RGB thumbnail is always downloaded (it is kept for classification);
+    its download overlaps the remaining thumbnail URL requests.
+    """
+    futures = {
+        name: thumb_executor.submit(fetch_thumbnail, layer, name, timer, download_all or name == 'rgb')
+        for name, layer in layers.items()
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+def fetch_local_products(masked_image, dataset, timer):
+    """Download the RGB bands in one NPY request and render LOCAL_PRODUCTS from them."""
+    bands = BAND_MAPPING.get(dataset, ['B4', 'B3', 'B2'])
+    # Masked pixels are zero-filled in the download, so carry the mask as its own band
+    stack = masked_image.select(bands).unmask(0).addBands(masked_image.select(bands[0]).mask().rename('mask'))
+    url = timer.timed('bands_url', stack.getDownloadURL,
+                      {'format': 'NPY', 'dimensions': THUMB_PARAMS['dimensions']})
+    response = timer.timed('download_bands', requests.get, url, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    band_arrays, valid = load_npy_bands(response.content, bands)
+    vis_range = VIS_RANGES.get(dataset, {"min": 0, "max": 3000})
+    return timer.timed('render_indices', render_products, band_arrays, vis_range, valid)
+
 @imagery_bp.route('/capture_image', methods=['POST', 'OPTIONS'])
 @cross_origin(origins="http://127.0.0.1:5000")
 def capture_image():
@@ -50,6 +221,8 @@ def capture_image():
     if request.method == 'OPTIONS':
         return '', 200
 
+    timer = StageTimer()
+    start = time.perf_counter()
     try:
         data = request.get_json()
         latitude = data.get('latitude')
@@ -63,79 +236,37 @@ def capture_image():
             logger.warning(f"Dataset '{dataset}' not allowed. Falling back to Sentinel-2.")
             dataset = "COPERNICUS/S2_SR_HARMONIZED"
 
-        point = ee.Geometry.Point([longitude, latitude])
-        region = point.buffer(100).bounds()
-
-        image_collection = ee.ImageCollection(dataset) \
-            .filterBounds(point) \
-            .filterDate('2023-01-01', '2024-12-31')
-
-        # Optional cloud filter for certain datasets
-        if dataset.startswith("COPERNICUS") or "LANDSAT" in dataset:
-            image_collection = image_collection.filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 10)) \
-                                               .sort('CLOUDY_PIXEL_PERCENTAGE')
+        product_names = LOCAL_PRODUCTS if LOCAL_INDICES else CAPTURE_IMAGES
 
-        image = image_collection.first()
+        # Snap to the cache grid so nearby captures share one query and its cached PNGs
+        cache_key, cached = None, None
+        query_latitude, query_longitude = latitude, longitude
+        if capture_cache.enabled:
+            geohash, query_latitude, query_longitude = snap_to_cell(latitude, longitude)
+            cache_key = capture_cache.key(dataset, CAPTURE_START_DATE, CAPTURE_END_DATE, geohash,
+                                          THUMB_PARAMS['dimensions'], 'local' if LOCAL_INDICES else 'thumbs')
+            cached = timer.timed('cache_lookup', capture_cache.get, cache_key, product_names)
 
-        if image is None:
-            return jsonify({"error": "No suitable image found for the selected dataset."}), 404
+        urls = {}
+        if cached is None:
+            masked_image = capture_query(get_ee(), query_latitude, query_longitude, dataset)
+            if masked_image is None:
+                return jsonify({"error": "No suitable image found for the selected dataset."}), 404
 
-        scl = image.select('SCL') if 'SCL' in image.bandNames().getInfo() else None
-
-        # Fix cloud mask logic: mask clouds and shadows (SCL 3, 8, 9, 10)
-        if scl:
-            cloud_mask = scl.eq(3).Or(scl.eq(8)).Or(scl.eq(9)).Or(scl.eq(10))
-            masked_image = image.updateMask(cloud_mask.Not())
+            if LOCAL_INDICES:
+                products = fetch_local_products(masked_image, dataset, timer)
+            else:
+                thumbs = request_thumbnails(capture_layers(masked_image, dataset), timer, download_all=cache_key is not None)
+                urls = {name: url for name, (url, _) in thumbs.items()}
+                products = {name: png for name, (_, png) in thumbs.items() if png is not None}
+            timer.timings['earth_engine'] = (time.perf_counter() - start) * 1000
+            if cache_key is not None:
+                timer.timed('cache_store', capture_cache.put, cache_key, products)
         else:
-            masked_image = image
-
-        # Band mapping per dataset
-        BAND_MAPPING = {
-            "COPERNICUS/S2_SR_HARMONIZED": ['B4', 'B3', 'B2'],
-            "LANDSAT/LC08/C02/T1_L2": ['SR_B4', 'SR_B3', 'SR_B2'],
-            "LANDSAT/LC09/C02/T1_L2": ['SR_B4', 'SR_B3', 'SR_B2'],
-            "MODIS/006/MOD09GA": ['sur_refl_b01', 'sur_refl_b04', 'sur_refl_b03'],
-            "USDA/NAIP/DOQQ": ['R', 'G', 'B']
-        }
-        bands = BAND_MAPPING.get(dataset, ['B4', 'B3', 'B2'])
-
-        # Visualization parameters per dataset
-        VIS_PARAMS = {
-            "COPERNICUS/S2_SR_HARMONIZED": {"bands": bands, "min": 0, "max": 3000},
-            "LANDSAT/LC08/C02/T1_L2": {"bands": bands, "min": 0, "max": 10000},
-            "LANDSAT/LC09/C02/T1_L2": {"bands": bands, "min": 0, "max": 10000},
-            "MODIS/006/MOD09GA": {"bands": bands, "min": 0, "max": 5000},
-            "USDA/NAIP/DOQQ": {"bands": bands, "min": 0, "max": 255}
-        }
-        vis_params = VIS_PARAMS.get(dataset, {"bands": bands, "min": 0, "max": 3000})
-
-        # NDVI, EVI, SAVI, GCI calculations adjusted for band names
-        ndvi = masked_image.normalizedDifference([bands[0], bands[1]]).rename('NDVI').visualize(min=-1, max=1, palette=['blue', 'white', 'green'])
-        evi = masked_image.expression(
-            '2.5 * ((b1 - b2) / (b1 + 6 * b2 - 7.5 * b3 + 1))',
-            {'b1': masked_image.select(bands[0]), 'b2': masked_image.select(bands[1]), 'b3': masked_image.select(bands[2])}
-        ).rename('EVI').visualize(min=-1, max=1, palette=['blue', 'white', 'green'])
-        savi = masked_image.expression(
-            '(b1 - b2) / (b1 + b2 + 0.5) * (1 + 0.5)',
-            {'b1': masked_image.select(bands[0]), 'b2': masked_image.select(bands[1])}
-        ).rename('SAVI').visualize(min=-1, max=1, palette=['blue', 'white', 'yellow'])
-        gci = masked_image.expression(
-            'b2 / b3 - 1',
-            {'b2': masked_image.select(bands[1]), 'b3': masked_image.select(bands[2])}
-        ).rename('GCI').visualize(min=-1, max=3, palette=['blue', 'white', 'green'])
-
-        # Thumbnail URLs with visualization parameters
-        raw_rgb_url = image.visualize(**vis_params).getThumbURL({'format': 'png', 'dimensions': 512})
-        rgb_url = masked_image.visualize(**vis_params).getThumbURL({'format': 'png', 'dimensions': 512})
-        ndvi_url = ndvi.getThumbURL({'format': 'png', 'dimensions': 512})
-        evi_url = evi.getThumbURL({'format': 'png', 'dimensions': 512})
-        savi_url = savi.getThumbURL({'format': 'png', 'dimensions': 512})
-        gci_url = gci.getThumbURL({'format': 'png', 'dimensions': 512})
-
-        # Download the RGB image and save locally for classification
-        rgb_response = requests.get(rgb_url)
-        rgb_response.raise_for_status()
-        rgb_image_data = rgb_response.content
+            products = {}
+            for name in product_names:
+                with open(cached[name], 'rb') as f:
+                    products[name] = f.read()
 
         # Save RGB image locally
         image_id = str(uuid.uuid4())
@@ -143,7 +274,20 @@ def capture_image():
         image_path = os.path.join('static', 'images', image_filename)
         os.makedirs(os.path.dirname(image_path), exist_ok=True)
         with open(image_path, 'wb') as f:
-            f.write(rgb_image_data)
+            timer.timed('save', f.write, products['rgb'])
+
+        # Index products we hold (computed locally or cached) are saved next to the RGB
+        # image, so history links outlive cache eviction; otherwise the Earth Engine
+        # thumbnail URLs are stored
+        stored_urls = dict(urls)
+        if all(name in products for name in INDEX_VIS):
+            stored_urls['rgb'] = os.path.join('images', image_filename)
+            for name in INDEX_VIS:
+                stored_urls[name] = os.path.join('images', f"{image_id}_{name}.png")
+                with open(os.path.join('static', stored_urls[name]), 'wb') as f:
+                    timer.timed(f"save_{name}", f.write, products[name])
+            urls = {name: url_for('static', filename=path.replace('\\', '/'), _external=True)
+                    for name, path in stored_urls.items()}
 
         # Store image record in database with correct field names
         session = Session()
@@ -151,26 +295,40 @@ def capture_image():
             latitude=latitude,
             longitude=longitude,
             image_url=os.path.join('images', image_filename),
-            ndvi_image_url=ndvi_url,
-            evi_image_url=evi_url,
-            savi_image_url=savi_url,
-            gci_image_url=gci_url,
-            raw_rgb_url=rgb_url
+            ndvi_image_url=stored_urls['ndvi'],
+            evi_image_url=stored_urls['evi'],
+            savi_image_url=stored_urls['savi'],
+            gci_image_url=stored_urls['gci'],
+            raw_rgb_url=stored_urls['rgb']
         )
         session.add(new_image)
-        session.commit()
+        timer.timed('db', session.commit)
+
+        timer.timings['total'] = (time.perf_counter() - start) * 1000
+        logger.info(f"capture_image timings (ms): {timer.header()}")
 
         # Normalize rgb_url to use forward slashes before returning
         normalized_rgb_url = new_image.image_url.replace('\\', '/')
-        return jsonify({
+        response = jsonify({
             "rgb_url": normalized_rgb_url,
-            "raw_rgb_url": rgb_url,
-            "ndvi_url": ndvi_url,
-            "evi_url": evi_url,
-            "savi_url": savi_url,
-            "gci_url": gci_url
+            "raw_rgb_url": urls['rgb'],
+            "ndvi_url": urls['ndvi'],
+            "evi_url": urls['evi'],
+            "savi_url": urls['savi'],
+            "gci_url": urls['gci'],
+            "cached": cached is not None
         })
+        response.headers['Server-Timing'] = timer.header()
+        return response
 
     except Exception as e:
         logger.error(f"Error in capture_image: {str(e)}")
         return jsonify({"error": str(e)}), 500
+
+@imagery_bp.route('/capture_cache/<key>/<name>.png', methods=['GET'])
+def cached_capture(key, name):
+    """Serve a cached capture PNG (links handed out before captures were saved to static/images)."""
+    path = capture_cache.path(key, name)
+    if path is None or not os.path.exists(path):
+        return jsonify({"error": "Capture not cached"}), 404
+    return send_file(path, mimetype='image/png', max_age=86400)
@@ -0,0 +1,87 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+# Visualization per index: (min, max, palette), matching the Earth Engine renders
+INDEX_VIS = {
+    'ndvi': (-1, 1, ['blue', 'white', 'green']),
+    'evi': (-1, 1, ['blue', 'white', 'green']),
+    'savi': (-1, 1, ['blue', 'white', 'yellow']),
+    'gci': (-1, 3, ['blue', 'white', 'green'])
+}
+
+# CSS colors, as Earth Engine interprets palette names
+PALETTE_COLORS = {
+    'blue': (0, 0, 255),
+    'white': (255, 255, 255),
+    'green': (0, 128, 0),
+    'yellow': (255, 255, 0)
+}
+
+
+def compute_indices(b1, b2, b3):
+    """NDVI, EVI, SAVI and GCI from the dataset's three mapped bands (see BAND_MAPPING).
+
+    Uses the same expressions as the Earth Engine path; pixels that divide by
+    zero come out non-finite and are treated as masked.
+    """
+    b1, b2, b3 = (np.asarray(b, dtype=np.float32) for b in (b1, b2, b3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'ndvi': (b1 - b2) / (b1 + b2),
+            'evi': 2.5 * ((b1 - b2) / (b1 + 6 * b2 - 7.5 * b3 + 1)),
+            'savi': (b1 - b2) / (b1 + b2 + 0.5) * (1 + 0.5),
+            'gci': b2 / b3 - 1
+        }
+
+
+def colorize(values, vmin, vmax, palette, valid=None):
+    """Map values onto an evenly spaced palette as RGBA; masked and non-finite pixels are transparent."""
+    values = np.asarray(values, dtype=np.float32)
+    colors = np.asarray([PALETTE_COLORS[c] for c in palette], dtype=np.float32)
+    position = np.clip((np.nan_to_num(values) - vmin) / (vmax - vmin), 0, 1) * (len(colors) - 1)
+    low = np.minimum(position.astype(int), len(colors) - 2)
+    frac = (position - low)[..., np.newaxis]
+    rgb = colors[low] * (1 - frac) + colors[low + 1] * frac
+
+    opaque = np.isfinite(values)
+    if valid is not None:
+        opaque &= valid
+    alpha = np.where(opaque, 255, 0)[..., np.newaxis]
+    return np.concatenate([np.round(rgb), alpha], axis=-1).astype(np.uint8)
+
+
+def stretch_rgb(b1, b2, b3, vmin, vmax, valid=None):
+    """Linear min/max stretch of three bands to RGBA, like ``image.visualize(min, max)``."""
+    rgb = np.stack([b1, b2, b3], axis=-1).astype(np.float32)
+    rgb = np.clip((rgb - vmin) / (vmax - vmin) * 255, 0, 255)
+    alpha = np.full(rgb.shape[:2] + (1,), 255, dtype=np.float32)
+    if valid is not None:
+        alpha[~valid] = 0
+    return np.concatenate([np.round(rgb), alpha], axis=-1).astype(np.uint8)
+
+
+def png_bytes(rgba):
+    buffer = io.BytesIO()
+    # Served locally, so favour encode speed over size
+    Image.fromarray(rgba).save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+def render_products(bands, vis_range, valid=None):
+    """PNG bytes for 'rgb' and every index in INDEX_VIS from one ``[b1, b2, b3]`` band stack."""
+    b1, b2, b3 = bands
+    products = {'rgb': png_bytes(stretch_rgb(b1, b2, b3, vis_range['min'], vis_range['max'], valid))}
+    for name, values in compute_indices(b1, b2, b3).items():
+        vmin, vmax, palette = INDEX_VIS[name]
+        products[name] = png_bytes(colorize(values, vmin, vmax, palette, valid))
+    return products
+
+
+def load_npy_bands(content, band_names, mask_band='mask'):
+    """Band arrays and validity mask from an Earth Engine ``NPY`` download (a structured array)."""
+    array = np.load(io.BytesIO(content), allow_pickle=False)
+    bands = [array[name].astype(np.float32) for name in band_names]
+    valid = array[mask_band] > 0 if mask_band in array.dtype.names else None
+    return bands, valid
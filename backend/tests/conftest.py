@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Configure before any backend module is imported: a throwaway database and
+# cache directories, and the fake Earth Engine module from this directory
+WORK_DIR = tempfile.mkdtemp(prefix='cubesat-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORK_DIR, 'test.db')}"
+os.environ['EE_MODULE'] = 'fake_ee'
+os.environ['CAPTURE_CACHE_DIR'] = os.path.join(WORK_DIR, 'capture_cache')
+os.environ['TRACK_STORE_DIR'] = os.path.join(WORK_DIR, 'track_store')
+
+for path in (TESTS_DIR, BACKEND_DIR, os.path.dirname(BACKEND_DIR)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+class StandIn:
+    """Responses served by the local HTTP stand-in, honouring ETag/Last-Modified validators."""
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []  # (path, request headers) per request received
+        self.port = None
+
+    def serve(self, path, body, etag=None, last_modified=None, content_type='text/plain'):
+        self.files[path] = (body if isinstance(body, bytes) else body.encode(), etag, last_modified, content_type)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def hits(self, path):
+        return sum(1 for p, _ in self.requests if p == path)
+
+
+def make_handler(stand_in):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            stand_in.requests.append((self.path, dict(self.headers)))
+            if self.path not in stand_in.files:
+                self.send_error(404)
+                return
+            body, etag, last_modified, content_type = stand_in.files[self.path]
+            if (etag and self.headers.get('If-None-Match') == etag) or \
+                    (last_modified and self.headers.get('If-Modified-Since') == last_modified):
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if etag:
+                self.send_header('ETag', etag)
+            if last_modified:
+                self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def http_stand_in():
+    """A local HTTP server standing in for Celestrak and Earth Engine downloads."""
+    stand_in = StandIn()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(stand_in))
+    stand_in.port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield stand_in
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def db():
+    """Fresh tables for the test; yields a session."""
+    from database import Base, SessionLocal, engine, init_db
+
+    init_db()
+    for table in reversed(Base.metadata.sorted_tables):
+        with engine.begin() as conn:
+            conn.execute(table.delete())
+    session = SessionLocal()
+    yield session
+    session.close()
@@ -0,0 +1,79 @@
+"""Local stand-in for the ``ee`` package, selected with ``EE_MODULE=fake_ee``.
+
+Building the computation graph is free: every chained call returns another
+fake image. The calls that are Earth Engine round trips (getThumbURL,
+getDownloadURL, getInfo) sleep for ``state.latency`` seconds and are recorded
+in ``state.calls``, together with how many were in flight at once.
+"""
+import threading
+import time
+
+
+class State:
+    def __init__(self):
+        self.reset()
+
+    def reset(self, latency=0.2, thumb_url=None, download_url=None):
+        self.latency = latency
+        self.thumb_url = thumb_url
+        self.download_url = download_url
+        self.calls = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+
+state = State()
+
+
+def _round_trip(name, result):
+    with state.lock:
+        state.calls.append(name)
+        state.in_flight += 1
+        state.peak_in_flight = max(state.peak_in_flight, state.in_flight)
+    try:
+        time.sleep(state.latency)
+    finally:
+        with state.lock:
+            state.in_flight -= 1
+    return result
+
+
+class Image:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: Image()
+
+    def getThumbURL(self, params):
+        return _round_trip('getThumbURL', state.thumb_url)
+
+    def getDownloadURL(self, params):
+        return _round_trip('getDownloadURL', state.download_url)
+
+    def getInfo(self):
+        return _round_trip('getInfo', {})
+
+
+ImageCollection = Image
+
+
+class Geometry:
+    Point = Image
+
+
+class Filter:
+    @staticmethod
+    def lt(*args):
+        return None
+
+
+def ServiceAccountCredentials(*args, **kwargs):
+    return None
+
+
+def Initialize(*args, **kwargs):
+    pass
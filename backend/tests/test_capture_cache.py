@@ -0,0 +1,62 @@
+import os
+import threading
+
+from capture_cache import CaptureCache, geohash_bounds, snap_to_cell
+
+
+def test_snap_to_cell_returns_cell_center():
+    geohash, latitude, longitude = snap_to_cell(12.9716, 77.5946, precision=7)
+    min_lat, min_lon, max_lat, max_lon = geohash_bounds(geohash)
+    assert len(geohash) == 7
+    assert min_lat <= 12.9716 <= max_lat and min_lon <= 77.5946 <= max_lon
+    assert (latitude, longitude) == ((min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+
+
+def test_concurrent_puts_of_one_key_all_succeed(tmp_path):
+    # Separate instances, like workers sharing the directory
+    caches = [CaptureCache(directory=str(tmp_path), max_bytes=1 << 20) for _ in range(8)]
+    key = CaptureCache.key('dataset', 'cell')
+    errors = []
+
+    def put(cache, n):
+        try:
+            cache.put(key, {'rgb': b'rgb', 'ndvi': bytes([n])})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put, args=(cache, n)) for n, cache in enumerate(caches) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert caches[0].get(key, ['rgb', 'ndvi']) is not None
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.tmp-')]
+
+
+def test_put_replaces_incomplete_entry(tmp_path):
+    cache = CaptureCache(directory=str(tmp_path), max_bytes=1 << 20)
+    key = CaptureCache.key('dataset', 'cell')
+    cache.put(key, {'rgb': b'old'})
+
+    paths = cache.put(key, {'rgb': b'new', 'ndvi': b'ndvi'})
+
+    assert cache.get(key, ['rgb', 'ndvi']) == paths
+    with open(paths['rgb'], 'rb') as f:
+        assert f.read() == b'new'
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = CaptureCache(directory=str(tmp_path), max_bytes=250)
+    first, second, third = (CaptureCache.key('cell', n) for n in range(3))
+    cache.put(first, {'rgb': b'x' * 100})
+    cache.put(second, {'rgb': b'x' * 100})
+    os.utime(os.path.join(tmp_path, first), (0, 0))
+    os.utime(os.path.join(tmp_path, second), (1, 1))
+    cache.get(first, ['rgb'])  # Now the most recently used
+
+    cache.put(third, {'rgb': b'x' * 100})
+
+    assert cache.get(second, ['rgb']) is None
+    assert cache.get(first, ['rgb']) is not None and cache.get(third, ['rgb']) is not None
@@ -0,0 +1,42 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from models import Classification
+from routes import classify
+
+STATIC_IMAGES = os.path.join(os.path.dirname(classify.__file__), '..', 'static', 'images')
+
+
+def png_bytes(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def downloads():
+    """Names of the files a test downloads into static/images; removed afterwards."""
+    before = set(os.listdir(STATIC_IMAGES))
+    added = lambda: set(os.listdir(STATIC_IMAGES)) - before
+    yield added
+    for name in added():
+        os.remove(os.path.join(STATIC_IMAGES, name))
+
+
+def test_unreadable_image_fails_only_its_own_item(db, http_stand_in, downloads):
+    http_stand_in.serve('/good.png', png_bytes((10, 120, 30)), content_type='image/png')
+    http_stand_in.serve('/copy.png', png_bytes((10, 120, 30)), content_type='image/png')
+    http_stand_in.serve('/bad.png', b'not an image', content_type='image/png')
+    good, copy, bad = (http_stand_in.url(path) for path in ('/good.png', '/copy.png', '/bad.png'))
+
+    results = classify.run_batch_classification([good, bad, copy])
+
+    assert results[1] == {"image_url": bad, "error": results[1]["error"], "status": 400}
+    assert results[0]["classification_percentages"]
+    assert results[2] == results[0]  # Same content: classified and stored once, under the kept copy
+    assert [row.image_url for row in db.query(Classification)] == [results[0]["image_url"]]
+    # Only the kept download remains; the unreadable file and the duplicate are removed
+    assert downloads() == {os.path.basename(results[0]["image_url"])}
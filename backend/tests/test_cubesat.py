@@ -0,0 +1,33 @@
+import pytest
+from flask import Flask
+
+from routes import cubesat
+
+
+@pytest.fixture
+def client(db):
+    app = Flask(__name__)
+    app.register_blueprint(cubesat.cubesat_bp, url_prefix='/api')
+    return app.test_client()
+
+
+@pytest.mark.parametrize('query', [
+    'max_epoch_age_days=nan', 'max_epoch_age_days=inf', 'max_epoch_age_days=0', 'max_epoch_age_days=-1',
+    'max_epoch_age_days=1e9', 'min_inclination=nan', 'min_inclination=-1', 'max_inclination=inf',
+    'max_inclination=181', 'max_inclination=abc',
+])
+def test_invalid_catalog_filters_are_rejected(client, query):
+    for path in ('/api/cubesat_positions', '/api/cubesat_orbits'):
+        response = client.get(f'{path}?{query}')
+        assert response.status_code == 400, (path, query)
+        assert 'error' in response.get_json()
+
+
+def test_valid_catalog_filters_are_accepted(client):
+    response = client.get('/api/cubesat_positions?max_epoch_age_days=30&min_inclination=0&max_inclination=180')
+    assert response.status_code == 200 and response.get_json() == []
+
+
+def test_non_finite_orbit_window_is_rejected(client):
+    assert client.get('/api/cubesat_orbits?interval_minutes=nan').status_code == 400
+    assert client.get('/api/cubesat_orbits?duration_days=inf').status_code == 400
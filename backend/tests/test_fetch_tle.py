@@ -0,0 +1,171 @@
+import datetime
+
+import pytest
+from flask import Flask
+
+from models import CubeSat, TleSourceState
+from routes import fetch_tle
+from routes.fetch_tle import claim_source, refresh_tle_catalog
+
+ISS = (
+    "ISS (ZARYA)",
+    "1 25544U 98067A   24001.50000000  .00016717  00000-0  10270-3 0  9005",
+    "2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.49815356432463"
+)
+
+
+def tle_text(*entries):
+    return "\n".join(line for entry in entries for line in entry) + "\n"
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(fetch_tle.tle_update_bp, url_prefix='/api')
+    return app.test_client()
+
+
+def test_failed_fetch_is_retried_after_backoff(db, http_stand_in):
+    url = http_stand_in.url('/missing.txt')  # 404
+
+    result = refresh_tle_catalog(db, [url])
+
+    assert result["failed"] == [url]
+    state = db.query(TleSourceState).filter_by(url=url).one()
+    due = state.last_checked + datetime.timedelta(hours=fetch_tle.UPDATE_INTERVAL_HOURS)
+    expected = datetime.datetime.utcnow() + datetime.timedelta(minutes=fetch_tle.RETRY_MINUTES)
+    assert abs((due - expected).total_seconds()) < 5
+    assert not claim_source(db, url)  # Backing off, not immediately due...
+
+    state.last_checked -= datetime.timedelta(minutes=fetch_tle.RETRY_MINUTES)
+    db.commit()
+    assert claim_source(db, url)  # ...but due once the retry delay has passed
+
+
+def test_update_tle_queues_refresh_only_when_due(db, http_stand_in, client, monkeypatch):
+    url = http_stand_in.url('/cubesat.txt')
+    http_stand_in.serve('/cubesat.txt', tle_text(ISS))
+    monkeypatch.setattr(fetch_tle.tle_scheduler, 'sources', [url])
+    triggered = []
+    monkeypatch.setattr(fetch_tle.tle_scheduler, 'trigger', lambda: triggered.append(True))
+
+    response = client.post('/api/update_tle')
+    assert response.status_code == 202 and triggered == [True]
+
+    refresh_tle_catalog(db, [url])
+    response = client.post('/api/update_tle')
+    assert response.status_code == 200
+    assert "not scheduled" in response.get_json()["message"]
+    assert response.get_json()["next_due"]
+    assert triggered == [True]
+
+
+def renumbered(entry, norad_id, name=None):
+    name_line, line1, line2 = entry
+    return (name or name_line, line1.replace("25544", str(norad_id)), line2.replace("25544", str(norad_id)))
+
+
+def test_objects_sharing_a_name_are_stored_separately(db):
+    records = fetch_tle.parse_tle_text(tle_text(renumbered(ISS, 25544, "OBJECT A"), renumbered(ISS, 25545, "OBJECT A")))
+
+    counts, _ = fetch_tle.apply_tle_updates(db, fetch_tle.dedupe_by_norad(records))
+    db.commit()
+
+    assert counts["added"] == 2 and counts["shared_names"] == 2
+    rows = db.query(CubeSat.norad_id, CubeSat.satellite).order_by(CubeSat.norad_id).all()
+    assert rows == [(25544, "OBJECT A"), (25545, "OBJECT A")]
+
+
+def test_renames_apply_and_unnamed_records_keep_the_stored_name(db):
+    fetch_tle.apply_tle_updates(db, fetch_tle.parse_tle_text(tle_text(ISS)))
+    db.commit()
+
+    counts, _ = fetch_tle.apply_tle_updates(db, fetch_tle.parse_tle_text(tle_text(renumbered(ISS, 25544, "ISS"))))
+    db.commit()
+    assert counts["updated"] == 1
+    assert db.query(CubeSat.satellite).filter_by(norad_id=25544).scalar() == "ISS"
+
+    counts, _ = fetch_tle.apply_tle_updates(db, fetch_tle.dedupe_by_norad(fetch_tle.parse_tle_text(tle_text(ISS[1:]))))
+    db.commit()
+    assert counts["unchanged"] == 1
+    assert db.query(CubeSat.satellite).filter_by(norad_id=25544).scalar() == "ISS"
+
+
+@pytest.fixture
+def cache_calls(monkeypatch):
+    """Records satrec cache invalidations and track store refreshes."""
+    calls = []
+    monkeypatch.setattr(fetch_tle.satrec_cache, 'invalidate', lambda ids: calls.append(('invalidate', list(ids))))
+    monkeypatch.setattr(fetch_tle.track_store, 'refresh_in_background', lambda: calls.append(('refresh',)))
+    return calls
+
+
+def catalog(db):
+    db.expire_all()
+    return db.query(CubeSat.id, CubeSat.norad_id, CubeSat.satellite, CubeSat.line1, CubeSat.line2,
+                    CubeSat.epoch).order_by(CubeSat.id).all()
+
+
+def test_not_modified_source_leaves_catalog_and_caches_alone(db, http_stand_in, cache_calls):
+    url = http_stand_in.url('/cubesat.txt')
+    http_stand_in.serve('/cubesat.txt', tle_text(ISS), etag='"v1"', last_modified='Mon, 01 Jan 2024 12:00:00 GMT')
+    assert refresh_tle_catalog(db, [url])["message"] == "TLE data updated"
+    before, cache_calls[:] = catalog(db), []
+
+    result = refresh_tle_catalog(db, [url], force=True)
+
+    assert result["message"] == "TLE data not modified"
+    assert result["sources"][0]["status"] == "not_modified"
+    headers = http_stand_in.requests[-1][1]
+    assert headers['If-None-Match'] == '"v1"'
+    assert headers['If-Modified-Since'] == 'Mon, 01 Jan 2024 12:00:00 GMT'
+    assert catalog(db) == before
+    assert cache_calls == []
+
+
+def test_identical_content_is_a_no_op(db, http_stand_in, cache_calls):
+    url = http_stand_in.url('/cubesat.txt')
+    http_stand_in.serve('/cubesat.txt', tle_text(ISS))  # No validators: every fetch is a full 200
+    refresh_tle_catalog(db, [url])
+    state = db.query(TleSourceState).filter_by(url=url).one()
+    content_hash, last_updated = state.content_hash, state.last_updated
+    before, cache_calls[:] = catalog(db), []
+
+    result = refresh_tle_catalog(db, [url], force=True)
+
+    assert result["message"] == "TLE data unchanged"
+    assert result["sources"][0]["status"] == "unchanged"
+    assert http_stand_in.hits('/cubesat.txt') == 2
+    db.expire_all()
+    assert (state.content_hash, state.last_updated) == (content_hash, last_updated)
+    assert catalog(db) == before
+    assert cache_calls == []
+
+
+def test_older_epoch_does_not_replace_newer_elements(db, http_stand_in, cache_calls):
+    url = http_stand_in.url('/cubesat.txt')
+    http_stand_in.serve('/cubesat.txt', tle_text(ISS))
+    refresh_tle_catalog(db, [url])
+    before, cache_calls[:] = catalog(db), []
+    older = (ISS[0], ISS[1].replace("24001.50000000", "23350.50000000"), ISS[2])
+    http_stand_in.serve('/cubesat.txt', tle_text(older))  # New content, older epoch
+
+    result = refresh_tle_catalog(db, [url], force=True)
+
+    assert result["stale"] == 1 and result["updated"] == 0 and result["added"] == 0
+    assert catalog(db) == before
+    assert cache_calls == [('invalidate', [])]  # Nothing changed, nothing to drop or rebuild
+
+
+def test_catalog_number_formats_are_deduplicated_by_value(db):
+    newer = renumbered(ISS, "00005", "VANGUARD 1")
+    older = renumbered(ISS, "    5", "VANGUARD 1")
+    older = (older[0], older[1].replace("24001.50000000", "23350.50000000"), older[2])
+    records = fetch_tle.parse_tle_text(tle_text(newer, older))
+
+    deduped = fetch_tle.dedupe_by_norad(records)
+    fetch_tle.apply_tle_updates(db, deduped)
+    db.commit()
+
+    assert [record["norad_id"] for record in deduped] == [5]
+    assert db.query(CubeSat.norad_id, CubeSat.line1).all() == [(5, newer[1])]
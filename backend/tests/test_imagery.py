@@ -0,0 +1,155 @@
+import io
+import os
+import shutil
+
+import numpy as np
+import pytest
+from flask import Flask
+from PIL import Image
+
+import fake_ee
+from capture_cache import capture_cache
+from database import SessionLocal
+from models import ImageHistory
+from routes import imagery
+from spectral import INDEX_VIS, render_products
+
+LATENCY = 0.2
+
+
+def png_bytes(color=(10, 120, 30)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(db, http_stand_in, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)  # Captures are saved under static/images
+    http_stand_in.serve('/thumb.png', png_bytes(), content_type='image/png')
+    fake_ee.state.reset(latency=LATENCY, thumb_url=http_stand_in.url('/thumb.png'))
+    monkeypatch.setattr(capture_cache, 'max_bytes', 0)  # Every capture goes to Earth Engine
+    app = Flask(__name__)
+    app.register_blueprint(imagery.imagery_bp, url_prefix='/api')
+    return app.test_client()
+
+
+def capture(client, latitude=12.9716, longitude=77.5946):
+    return client.post('/api/capture_image', json={
+        'latitude': latitude, 'longitude': longitude, 'dataset': 'COPERNICUS/S2_SR_HARMONIZED'})
+
+
+def server_timing(response):
+    stages = {}
+    for entry in response.headers['Server-Timing'].split(', '):
+        name, duration = entry.split(';dur=')
+        stages[name] = float(duration)
+    return stages
+
+
+def test_thumbnail_urls_are_requested_concurrently(client, http_stand_in):
+    response = capture(client)
+
+    assert response.status_code == 200
+    layers = len(imagery.CAPTURE_IMAGES)
+    # One round trip per product and no bandNames().getInfo() lookup
+    assert fake_ee.state.calls == ['getThumbURL'] * layers
+    assert fake_ee.state.peak_in_flight == layers
+    # Only the RGB thumbnail is downloaded when nothing is cached
+    assert http_stand_in.hits('/thumb.png') == 1
+    saved = os.path.join('static', response.get_json()['rgb_url'])
+    with open(saved, 'rb') as f:
+        assert f.read() == http_stand_in.files['/thumb.png'][0]
+
+
+def test_server_timing_reports_each_stage(client):
+    response = capture(client)
+
+    stages = server_timing(response)
+    thumbs = [f"thumb_{name}" for name in imagery.CAPTURE_IMAGES]
+    assert set(thumbs + ['download_rgb', 'earth_engine', 'save', 'db', 'total']) <= set(stages)
+    assert all(stages[name] >= LATENCY * 1000 * 0.9 for name in thumbs)
+    # Concurrent round trips: the capture takes about one call, not one per product
+    assert stages['earth_engine'] < sum(stages[name] for name in thumbs) / 2
+
+
+def test_history_links_outlive_cache_eviction(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(capture_cache, 'directory', str(tmp_path / 'cache'))
+    monkeypatch.setattr(capture_cache, 'max_bytes', 1 << 20)
+
+    first = capture(client).get_json()
+    shutil.rmtree(capture_cache.directory)  # Evicted
+    calls = len(fake_ee.state.calls)
+    second = capture(client, latitude=12.97161).get_json()  # Same geohash cell
+
+    assert not first['cached'] and len(fake_ee.state.calls) == calls + len(imagery.CAPTURE_IMAGES)
+    session = SessionLocal()
+    try:
+        rows = session.query(ImageHistory).order_by(ImageHistory.id).all()
+    finally:
+        session.close()
+    assert len(rows) == 2
+    for row in rows:
+        for url in (row.raw_rgb_url, row.ndvi_image_url, row.evi_image_url, row.savi_image_url, row.gci_image_url):
+            assert not url.startswith('http')
+            assert os.path.exists(os.path.join('static', url))
+    assert second['ndvi_url'].endswith(rows[1].ndvi_image_url.replace('\\', '/'))
+
+
+def test_cached_capture_skips_earth_engine(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(capture_cache, 'directory', str(tmp_path / 'cache'))
+    monkeypatch.setattr(capture_cache, 'max_bytes', 1 << 20)
+
+    capture(client)
+    calls = len(fake_ee.state.calls)
+    response = capture(client, latitude=12.97161)
+
+    assert response.get_json()['cached'] is True
+    assert len(fake_ee.state.calls) == calls
+    assert 'cache_lookup' in server_timing(response)
+
+
+def npy_bands(size=16):
+    """A structured NPY download like Earth Engine's: one field per band plus the mask."""
+    rng = np.random.default_rng(0)
+    array = np.zeros((size, size), dtype=[('B4', '<i4'), ('B3', '<i4'), ('B2', '<i4'), ('mask', '<i4')])
+    for band in ('B4', 'B3', 'B2'):
+        array[band] = rng.integers(0, 3000, (size, size))
+    array['mask'] = 1
+    array['mask'][0] = 0  # One masked row
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return array, buffer.getvalue()
+
+
+def test_local_indices_are_rendered_from_one_band_download(client, http_stand_in, monkeypatch):
+    array, content = npy_bands()
+    http_stand_in.serve('/bands.npy', content, content_type='application/octet-stream')
+    fake_ee.state.download_url = http_stand_in.url('/bands.npy')
+    monkeypatch.setattr(imagery, 'LOCAL_INDICES', True)
+
+    response = capture(client)
+
+    assert response.status_code == 200
+    assert fake_ee.state.calls == ['getDownloadURL']  # No thumbnails
+    assert http_stand_in.hits('/bands.npy') == 1 and http_stand_in.hits('/thumb.png') == 0
+    assert {'bands_url', 'download_bands', 'render_indices'} <= set(server_timing(response))
+
+    expected = render_products([array[band].astype(np.float32) for band in ('B4', 'B3', 'B2')],
+                               imagery.VIS_RANGES['COPERNICUS/S2_SR_HARMONIZED'], array['mask'] > 0)
+    session = SessionLocal()
+    try:
+        row = session.query(ImageHistory).one()
+    finally:
+        session.close()
+    stored = {'rgb': row.raw_rgb_url, 'ndvi': row.ndvi_image_url, 'evi': row.evi_image_url,
+              'savi': row.savi_image_url, 'gci': row.gci_image_url}
+    assert set(stored) == {'rgb', *INDEX_VIS}
+    body = response.get_json()
+    for name, url in stored.items():
+        assert not url.startswith('http')
+        with open(os.path.join('static', url), 'rb') as f:
+            assert f.read() == expected[name]
+        assert body[f"{'raw_rgb' if name == 'rgb' else name}_url"].endswith(url.replace('\\', '/'))
+    with Image.open(os.path.join('static', row.ndvi_image_url)) as png:
+        assert png.size == (16, 16) and png.getpixel((0, 0))[3] == 0  # Masked pixels are transparent
@@ -0,0 +1,14 @@
+import pytest
+
+from ai_model.infer import parse_stride
+
+
+def test_stride_accepts_one_or_two_values():
+    assert parse_stride("32") == (32, 32)
+    assert parse_stride("32,16") == (32, 16)
+
+
+@pytest.mark.parametrize('value', ["0", "32,0", "-8", "32,32,32", "", "a,b"])
+def test_stride_rejects_invalid_values(value):
+    with pytest.raises(ValueError, match="PATCH_STRIDE"):
+        parse_stride(value)
@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+from flask import Flask
+
+from jobs import JobQueue, JobQueueFull
+from routes import classify
+
+
+def wait_for(queue, job_id, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        job = queue.get(job_id)
+        if job["status"] in ("finished", "failed"):
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def test_job_state_is_visible_to_other_queues(db):
+    worker, other_worker = JobQueue(max_workers=1), JobQueue(max_workers=1)
+
+    job_id = worker.submit(lambda n: {"doubled": n * 2}, 21)
+
+    job = wait_for(other_worker, job_id)  # Another process polling the same database
+    assert job["status"] == "finished" and job["result"] == {"doubled": 42}
+    failed = wait_for(other_worker, worker.submit(lambda: 1 / 0))
+    assert failed["status"] == "failed" and "division by zero" in failed["error"]
+    assert other_worker.get("unknown") is None
+
+
+def test_full_queue_refuses_jobs(db, monkeypatch):
+    release = threading.Event()
+    queue = JobQueue(max_workers=1, max_queued=2)
+    monkeypatch.setattr(classify, 'classify_jobs', queue)
+    app = Flask(__name__)
+    app.register_blueprint(classify.classify_bp, url_prefix='/api')
+    client = app.test_client()
+
+    try:
+        job_ids = [queue.submit(release.wait), queue.submit(release.wait)]
+        with pytest.raises(JobQueueFull):
+            queue.submit(release.wait)
+        response = client.post('/api/classify_image', json={'image_url': 'images/x.png', 'async': True})
+        assert response.status_code == 503 and response.headers['Retry-After']
+    finally:
+        release.set()
+    for job_id in job_ids:
+        wait_for(queue, job_id)
+    assert queue.submit(lambda: None) is not None  # Room again once the jobs finished
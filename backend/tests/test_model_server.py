@@ -0,0 +1,47 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ai_model import infer
+from ai_model.model_server import InferenceServer
+
+
+def server_threads():
+    return sum(thread.name == 'inference-server' for thread in threading.enumerate())
+
+
+def test_predictions_are_split_back_per_request():
+    server = InferenceServer(lambda: 'model', lambda model, patches: patches.sum(axis=1, keepdims=True)).start()
+    try:
+        futures = [server.submit(np.full((n, 2), n)) for n in (1, 2, 3)]
+        assert [future.result().ravel().tolist() for future in futures] == [[2], [4, 4], [6, 6, 6]]
+    finally:
+        server.stop()
+
+
+def test_failed_model_load_is_reused_until_the_retry_delay(monkeypatch):
+    loads = []
+
+    def load_model():
+        loads.append(time.monotonic())
+        raise OSError("best_model.keras not found")
+
+    monkeypatch.setattr(infer, 'load_model', load_model)
+    monkeypatch.setattr(infer, '_inference_server', None)
+    before = server_threads()
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError, match="not found"):
+            infer.get_inference_server()
+    time.sleep(0.05)
+    assert len(loads) == 1
+    assert server_threads() == before  # The worker exits instead of blocking on its queue
+    with pytest.raises(RuntimeError, match="not found"):
+        infer._inference_server.predict(np.zeros((1, 64, 64, 3)))
+
+    monkeypatch.setattr(infer, 'MODEL_LOAD_RETRY_SECONDS', 0)
+    with pytest.raises(RuntimeError):
+        infer.get_inference_server()
+    assert len(loads) == 2
@@ -0,0 +1,71 @@
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Compact little-endian layout for position/orbit responses:
+#
+#   header  '<4sBBHIIdd'  magic b'CSAT', version, kind, reserved,
+#                         n_satellites, n_times, start (unix seconds), step (seconds)
+#   names   n_satellites x (uint16 byte length + UTF-8 name), zero-padded to 4 bytes
+#   points  float32[n_satellites][n_times][3] as lat, lon, alt (km); NaN = no data
+BINARY_MIMETYPE = 'application/vnd.cubesat.tracks'
+MAGIC = b'CSAT'
+VERSION = 1
+KIND_POSITIONS = 1
+KIND_ORBITS = 2
+HEADER = struct.Struct('<4sBBHIIdd')
+
+
+def _unix_seconds(when):
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def encode_tracks(kind, names, start, step_minutes, lat, lon, alt):
+    """Pack ``(n_satellites, n_times)`` lat/lon/alt arrays into the binary layout."""
+    lat = np.asarray(lat, dtype=np.float32)
+    n_sats, n_times = lat.shape if lat.ndim == 2 else (len(names), 0)
+
+    parts = [HEADER.pack(MAGIC, VERSION, kind, 0, n_sats, n_times,
+                         _unix_seconds(start), step_minutes * 60.0)]
+    name_table = bytearray()
+    for name in names:
+        encoded = name.encode('utf-8')[:0xFFFF]
+        name_table += struct.pack('<H', len(encoded)) + encoded
+    name_table += b'\0' * (-len(name_table) % 4)
+    parts.append(bytes(name_table))
+
+    points = np.empty((n_sats, n_times, 3), dtype='<f4')
+    points[..., 0] = lat
+    points[..., 1] = lon
+    points[..., 2] = alt
+    parts.append(points.tobytes())
+    return b''.join(parts)
+
+
+def decode_tracks(payload):
+    """Inverse of :func:`encode_tracks`; returns a dict of header fields and arrays."""
+    magic, version, kind, _, n_sats, n_times, start, step = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a CubeSat track payload")
+    offset = HEADER.size
+    names = []
+    for _ in range(n_sats):
+        (length,) = struct.unpack_from('<H', payload, offset)
+        offset += 2
+        names.append(payload[offset:offset + length].decode('utf-8'))
+        offset += length
+    offset += -(offset - HEADER.size) % 4
+    points = np.frombuffer(payload, dtype='<f4', count=n_sats * n_times * 3, offset=offset)
+    points = points.reshape(n_sats, n_times, 3)
+    return {
+        'kind': kind,
+        'names': names,
+        'start': datetime.fromtimestamp(start, tz=timezone.utc),
+        'step_minutes': step / 60.0,
+        'lat': points[..., 0],
+        'lon': points[..., 1],
+        'alt': points[..., 2],
+    }
@@ -0,0 +1,260 @@
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from database import SessionLocal
+from models import CubeSat
+from propagation import Tracks, compute_tracks, tle_digest
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock applies
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+TRACK_STORE_DIR = os.getenv('TRACK_STORE_DIR', os.path.join(os.path.dirname(__file__), 'track_store'))
+STEP_MINUTES = 1  # Resolution of the stored tracks
+HORIZON_DAYS = 2  # How far ahead each materialization reaches
+BUCKET_MINUTES = 60  # Materializations start on a bucket boundary
+REFRESH_INTERVAL_HOURS = 12
+MATERIALIZE_CHUNK = 512  # Satellites propagated at a time while materializing
+
+
+class TrackStore:
+    """Precomputed ground tracks stored as memory-mapped NumPy arrays.
+
+    Each materialization writes a ``tracks_<stamp>`` directory holding
+    ``tracks.npy``, a float32 array of shape (n_satellites, n_steps, 3) with
+    lat/lon/alt (NaN where SGP4 failed), and an ``index.json`` describing the
+    time grid and which satellite/TLE each row belongs to. The ``CURRENT``
+    file names the directory to serve and is swapped atomically once a
+    materialization is complete. A file lock keeps workers sharing the
+    directory from materializing at the same time. Requests are served by
+    slicing the mapped array; anything the store cannot cover returns None
+    so callers fall back to live propagation.
+    """
+
+    def __init__(self, directory=TRACK_STORE_DIR, step_minutes=STEP_MINUTES,
+                 horizon_days=HORIZON_DAYS, bucket_minutes=BUCKET_MINUTES):
+        self.directory = directory
+        self.step_minutes = step_minutes
+        self.horizon_days = horizon_days
+        self.bucket_minutes = bucket_minutes
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._loaded = None  # (index mtime, index, positions, mmap)
+
+    @property
+    def current_path(self):
+        return os.path.join(self.directory, 'CURRENT')
+
+    def _current_generation(self):
+        try:
+            with open(self.current_path) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _read_index(self, generation):
+        with open(os.path.join(self.directory, generation, 'index.json')) as f:
+            return json.load(f)
+
+    @contextmanager
+    def _process_lock(self):
+        """Yield whether this process holds the directory's refresh lock."""
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.directory, '.refresh.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                locked = False
+            else:
+                locked = True
+            try:
+                yield locked
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _bucket_start(self, when):
+        minutes = (when.hour * 60 + when.minute) // self.bucket_minutes * self.bucket_minutes
+        return when.replace(hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0)
+
+    def refresh(self, rows, start=None):
+        """Materialize tracks for ``rows`` starting at the current bucket.
+
+        Returns the new index, the current one if it already covers the same
+        bucket and TLEs, or None if another process is materializing.
+        """
+        start = self._bucket_start(start or datetime.utcnow())
+        satellites = [
+            {'id': row.id, 'satellite': row.satellite, 'digest': tle_digest(row.line1, row.line2)}
+            for row in rows
+        ]
+        os.makedirs(self.directory, exist_ok=True)
+        with self._process_lock() as locked:
+            if not locked:
+                logger.info("Track store refresh running in another process; skipping")
+                return None
+
+            previous = self._current_generation()
+            if previous:
+                try:
+                    index = self._read_index(previous)
+                    if index['start'] == start.isoformat() and index['satellites'] == satellites:
+                        return index  # Another worker just materialized this
+                except (OSError, ValueError, KeyError):
+                    pass
+
+            generation = f"tracks_{start:%Y%m%dT%H%M}_{os.getpid()}_{int(time.time() * 1000)}"
+            generation_dir = os.path.join(self.directory, generation)
+            os.makedirs(generation_dir)
+            steps = self._materialize(rows, start, os.path.join(generation_dir, 'tracks.npy'))
+            index = {
+                'start': start.isoformat(),
+                'step_minutes': self.step_minutes,
+                'steps': steps,
+                'satellites': satellites
+            }
+            with open(os.path.join(generation_dir, 'index.json'), 'w') as f:
+                json.dump(index, f)
+
+            tmp_path = f"{self.current_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(generation)
+            os.replace(tmp_path, self.current_path)
+
+            # Keep the generation being replaced for readers that resolved it just before the swap
+            self._remove_old_generations(keep={generation, previous})
+        logger.info(f"Track store refreshed: {len(rows)} satellites x {steps} steps from {start}")
+        return index
+
+    def _materialize(self, rows, start, path):
+        """Propagate ``rows`` in chunks straight into a float32 ``.npy``; returns the step count."""
+        steps = len(np.arange(0, self.horizon_days * 24 * 60, self.step_minutes, dtype=float))
+        data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(rows), steps, 3))
+        for offset in range(0, len(rows), MATERIALIZE_CHUNK):
+            chunk = rows[offset:offset + MATERIALIZE_CHUNK]
+            tracks = compute_tracks(chunk, start=start, duration_days=self.horizon_days,
+                                    interval_minutes=self.step_minutes)
+            # Rows whose TLE failed to parse are kept as all-NaN tracks
+            block = np.full((len(chunk), steps, 3), np.nan, dtype=np.float32)
+            for axis, values in enumerate((tracks.lat, tracks.lon, tracks.alt)):
+                block[tracks.index, :, axis] = np.where(tracks.ok, values, np.nan)
+            data[offset:offset + len(chunk)] = block
+        data.flush()
+        del data
+        return steps
+
+    def _remove_old_generations(self, keep):
+        for name in os.listdir(self.directory):
+            if not (name.startswith('tracks_') or name == 'index.json') or name in keep:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)  # Files of the single-directory layout
+            except OSError as e:
+                logger.debug(f"Could not remove old track data {name}: {e}")
+
+    def _load(self):
+        generation = self._current_generation()
+        if generation is None:
+            return None
+        with self._lock:
+            if self._loaded is None or self._loaded[0] != generation:
+                index = self._read_index(generation)
+                data = np.load(os.path.join(self.directory, generation, 'tracks.npy'), mmap_mode='r')
+                positions = {(s['id'], s['digest']): k for k, s in enumerate(index['satellites'])}
+                self._loaded = (generation, index, positions, data)
+            return self._loaded[1:]
+
+    def window(self, rows, start=None, duration_days=1, interval_minutes=10):
+        """Slice stored tracks for ``rows``, or None if the store can't serve the window."""
+        try:
+            loaded = self._load()
+        except Exception as e:
+            logger.warning(f"Track store unavailable: {e}")
+            return None
+        if loaded is None:
+            return None
+        index, positions, data = loaded
+
+        step = index['step_minutes']
+        stride = interval_minutes / step
+        if stride != int(stride):
+            return None
+        stride = int(stride)
+
+        store_start = datetime.fromisoformat(index['start'])
+        elapsed = ((start or datetime.utcnow()) - store_start).total_seconds() / 60
+        first = max(0, math.ceil(elapsed / step))
+        count = len(np.arange(0, duration_days * 24 * 60, interval_minutes))
+        last = first + (count - 1) * stride
+        if last >= index['steps']:
+            return None
+
+        track_rows, track_index = [], []
+        for i, row in enumerate(rows):
+            k = positions.get((row.id, tle_digest(row.line1, row.line2)))
+            if k is None:
+                return None  # Unknown satellite or TLE changed since materialization
+            track_rows.append(k)
+            track_index.append(i)
+
+        sliced = np.asarray(data[track_rows, first:last + 1:stride], dtype=np.float64)
+        lat, lon, alt = sliced[..., 0], sliced[..., 1], sliced[..., 2]
+        return Tracks(
+            store_start + timedelta(minutes=first * step),
+            np.arange(count, dtype=float) * interval_minutes,
+            np.asarray(track_index, dtype=np.intp),
+            lat, lon, alt, np.isfinite(alt)
+        )
+
+    def refresh_from_db(self):
+        """Rebuild the store from the current CubeSat table."""
+        if not self._refresh_lock.acquire(blocking=False):
+            logger.info("Track store refresh already running; skipping")
+            return None
+        session = SessionLocal()
+        try:
+            return self.refresh(session.query(CubeSat).all())
+        except Exception as e:
+            logger.error(f"Track store refresh failed: {e}")
+            return None
+        finally:
+            session.close()
+            self._refresh_lock.release()
+
+    def refresh_in_background(self):
+        """Rebuild the store without blocking the caller."""
+        thread = threading.Thread(target=self.refresh_from_db, name='track-store-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def start_scheduler(self, interval_hours=REFRESH_INTERVAL_HOURS):
+        """Refresh now and then every ``interval_hours`` on a daemon thread."""
+        def run():
+            while True:
+                self.refresh_from_db()
+                time.sleep(interval_hours * 3600)
+
+        thread = threading.Thread(target=run, name='track-store-scheduler', daemon=True)
+        thread.start()
+        return thread
+
+
+track_store = TrackStore()
@@ -24,12 +24,67 @@ export async function fetchWrapper(url, options = {}) {
     }
 }
 
+export const TRACKS_MIMETYPE = 'application/vnd.cubesat.tracks';
+
+/**
+ * Decode the compact binary track layout served for `Accept: application/vnd.cubesat.tracks`.
+ * Layout (little-endian): 32-byte header (magic 'CSAT', version, kind, reserved,
+ * satellite count, time count, start unix seconds, step seconds), a name table of
+ * uint16 length + UTF-8 bytes padded to 4 bytes, then float32 lat/lon/alt triples.
+ * @param {ArrayBuffer} buffer - Response body.
+ * @returns {{names: string[], start: Date, stepSeconds: number, timeCount: number, points: Float32Array}}
+ */
+export function decodeTracks(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== 'CSAT' || view.getUint8(4) !== 1) {
+        throw new Error('Invalid track payload');
+    }
+    const satCount = view.getUint32(8, true);
+    const timeCount = view.getUint32(12, true);
+    const start = new Date(view.getFloat64(16, true) * 1000);
+    const stepSeconds = view.getFloat64(24, true);
+
+    const decoder = new TextDecoder();
+    const names = [];
+    let offset = 32;
+    for (let i = 0; i < satCount; i++) {
+        const length = view.getUint16(offset, true);
+        names.push(decoder.decode(new Uint8Array(buffer, offset + 2, length)));
+        offset += 2 + length;
+    }
+    offset += (4 - ((offset - 32) % 4)) % 4;
+
+    const points = new Float32Array(buffer, offset, satCount * timeCount * 3);
+    return { names, start, stepSeconds, timeCount, points };
+}
+
+/**
+ * Fetch current CubeSat positions using the binary format.
+ * @returns {Promise<Array<{satellite: string, lat: number, lon: number, alt: number}>>}
+ */
+export async function fetchCubeSatPositions() {
+    const response = await fetch(`${BASE_URL}/cubesat_positions`, {
+        headers: { Accept: TRACKS_MIMETYPE }
+    });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}, message: ${await response.text()}`);
+    }
+    const { names, points } = decodeTracks(await response.arrayBuffer());
+    return names.map((satellite, i) => ({
+        satellite,
+        lat: points[i * 3],
+        lon: points[i * 3 + 1],
+        alt: points[i * 3 + 2]
+    }));
+}
+
 /**
  * Fetch CubeSat positional data and update the Cesium viewer.
  */
 export async function fetchCubeSatData(viewer) {
     try {
-        const data = await fetchWrapper(`${BASE_URL}/cubesat_positions`);
+        const data = await fetchCubeSatPositions();
 
         console.log("Received API Data:", data); // Log raw API response
 